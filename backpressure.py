@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Decides how long kcing should wait before sending the next document to
+# logstash, based on how busy logstash looks instead of a fixed interval
+
+import json
+import logging
+import time
+
+import metrics
+import settings
+
+logger = logging.getLogger()
+
+
+class Backpressure(object):
+
+    def __init__(self, client, fallback_every=10):
+        # Http client used to poll logstash's node stats api
+        self.client = client
+        self.stats_url = '%s/_node/stats' % (settings.LS_API)
+
+        # When stats are not available, sleep ES_LOAD_INTERVAL after every `fallback_every` documents (if set)
+        self.fallback_every = fallback_every
+        self.stats_available = True
+
+        # Current delay between documents, it grows when logstash is busy and shrinks when it's idle
+        self.delay = 0
+        self.min_delay = 0.1
+        self.max_delay = settings.ES_MAX_LOAD_INTERVAL
+
+        # Post latency per byte, smoothed, and the fastest one seen lately for each type of document.
+        # When stats are not available, posts getting much slower than usual are the only hint of a
+        # struggling logstash. Lavas and batches of builds are nothing alike, hence kept apart
+        self.latency = {}
+        self.fastest = {}
+        self.last_type = None
+
+        self.sent = 0
+        self.slept = 0
+        self.last_poll = 0
+
+    def _stats(self):
+        """Return (queued events, heap used percent) of kcing pipeline, or None if not available"""
+        try:
+            response = self.client.get(self.stats_url, timeout=5, retries=0)
+        except:
+            logger.warning('Cannot reach logstash stats at "%s"' % (self.stats_url))
+            return None
+
+        if response.status_code != 200:
+            logger.warning('Logstash stats returned %i' % (response.status_code))
+            return None
+
+        try:
+            stats = json.loads(response.content.decode())
+            heap = stats['jvm']['mem']['heap_used_percent']
+            queue = stats['pipelines'][settings.LS_PIPELINE_ID].get('queue', {})
+            queued = queue.get('events_count', queue.get('events', 0))
+        except (ValueError, KeyError) as e:
+            logger.warning('Unexpected logstash stats: %s' % (e))
+            return None
+
+        return queued, heap
+
+    def record(self, latency, size=None, _type=None):
+        """Record how long the last post, of `size` bytes of `_type` documents, took"""
+        rate = latency / size if size else latency
+        before = self.latency.get(_type)
+        self.latency[_type] = rate if before is None else 0.8 * before + 0.2 * rate
+
+        # The fastest post slowly fades away, otherwise a lucky one would make every other look slow
+        fastest = self.fastest.get(_type)
+        self.fastest[_type] = rate if fastest is None else min(fastest * 1.01, rate)
+        self.last_type = _type
+
+    def _is_slow(self):
+        """Posts getting much slower than usual mean logstash can't keep up"""
+        latency = self.latency.get(self.last_type)
+        fastest = self.fastest.get(self.last_type)
+        if latency is None or not fastest:
+            return False
+
+        if latency > 3 * fastest:
+            logger.debug('Posts are taking %.2f times as long as they did at best' % (latency / fastest))
+            return True
+
+        return False
+
+    def _is_busy(self, queued, heap):
+        if heap >= settings.LS_MAX_HEAP_PERCENT:
+            logger.debug('Logstash heap is at %i%%' % (heap))
+            return True
+
+        if queued >= settings.LS_MAX_QUEUED_EVENTS:
+            logger.debug('Logstash has %i events queued' % (queued))
+            return True
+
+        return False
+
+    def _adjust(self, busy):
+        """Double the delay while logstash is busy, halve it back when it's not"""
+        if busy:
+            self.delay = min(self.max_delay, max(self.delay * 2, self.min_delay))
+        else:
+            self.delay = self.delay / 2 if self.delay / 2 >= self.min_delay else 0
+
+    def _fallback(self):
+        if self.fallback_every and (self.sent % self.fallback_every) == 0:
+            logger.info('Wait a bit to let logstash digest more %i events. Sleeping for %i seconds' % (self.fallback_every, settings.ES_LOAD_INTERVAL))
+            return settings.ES_LOAD_INTERVAL
+        return 0
+
+    def wait(self):
+        """Called after every document sent, sleeps as much as logstash needs"""
+        self.sent += 1
+
+        # Polling stats every time would be a burden on its own
+        if self.stats_available and time.time() - self.last_poll >= 1:
+            self.last_poll = time.time()
+            stats = self._stats()
+            if stats is None:
+                logger.warning('Logstash stats not available, falling back to ES_LOAD_INTERVAL sleeps')
+                self.stats_available = False
+            else:
+                self._adjust(self._is_busy(*stats))
+
+        if self.stats_available:
+            delay = self.delay
+        else:
+            self._adjust(self._is_slow())
+            delay = max(self.delay, self._fallback())
+        if delay > 0:
+            logger.debug('Sleeping %.2fs before sending more to logstash' % (delay))
+            time.sleep(delay)
+            self.slept += delay
+            metrics.inc('kcing_backpressure_sleep_seconds_total', delay)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Spreads posts over several logstash nodes taking the same kind of documents,
+# picking the one with the fewest requests in flight. Nodes that fail are
+# ejected for ES_EJECT_INTERVAL seconds and health checked before coming back
+
+import logging
+import threading
+import time
+
+import metrics
+import settings
+
+logger = logging.getLogger()
+
+
+def split_urls(value):
+    """ES_LAVA, ES_BUILD and ES_BOOT might hold several comma separated urls"""
+    return [url.strip() for url in (value or '').split(',') if url.strip()]
+
+
+class Balancer(object):
+
+    def __init__(self, urls, check, eject_for=None):
+        self.urls = list(urls)
+
+        # check(url) tells whether a node is healthy, see elastic._is_ls_ok
+        self.check = check
+        self.eject_for = settings.ES_EJECT_INTERVAL if eject_for is None else eject_for
+
+        self.outstanding = {url: 0 for url in self.urls}
+        self.ejected = {} # [url] = when it can be checked again
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def _eject(self, url):
+        self.ejected[url] = time.time() + self.eject_for
+        metrics.inc('kcing_ls_ejections_total', url=url)
+
+    def eject(self, url):
+        with self.lock:
+            # The last node standing is never ejected, otherwise there'd be nowhere to send anything.
+            # Failing posts to it are up to the caller
+            left = [u for u in self.urls if u not in self.ejected]
+            if left == [url]:
+                logger.warning('Keeping "%s", it is the last healthy node left' % (url))
+                return
+            self._eject(url)
+        logger.warning('Ejected "%s" for %i seconds' % (url, self.eject_for))
+
+    def _due(self):
+        """Ejected nodes whose time is up"""
+        now = time.time()
+        return [url for url, until in self.ejected.items() if until <= now]
+
+    def _recheck(self, urls):
+        """Bring ejected nodes back if they look healthy again, otherwise eject them for another while"""
+        for url in urls:
+            healthy = self.check(url)
+            with self.lock:
+                if healthy:
+                    self.ejected.pop(url, None)
+                else:
+                    self._eject(url)
+
+            if healthy:
+                logger.info('"%s" is back' % (url))
+
+    def check_all(self):
+        """Health check every node, ejecting unhealthy ones. Returns the number of healthy nodes"""
+        healthy = 0
+        for url in self.urls:
+            if self.check(url):
+                with self.lock:
+                    self.ejected.pop(url, None)
+                healthy += 1
+            else:
+                self.eject(url)
+        return healthy
+
+    def healthy(self, exclude=()):
+        """Nodes not ejected, nor in exclude"""
+        with self.lock:
+            due = self._due()
+        if len(due):
+            self._recheck(due)
+
+        with self.lock:
+            return [url for url in self.urls if url not in self.ejected and url not in exclude]
+
+    def acquire(self, exclude=()):
+        """
+        Pick the healthy node with the fewest requests in flight, going round robin among ties.
+        Returns None when all of them are ejected (or excluded). Every acquire needs a release
+        """
+        candidates = self.healthy(exclude)
+        if len(candidates) == 0:
+            return None
+
+        with self.lock:
+            # Rotate where ties start from, so that idle nodes take turns
+            start = self.next % len(self.urls)
+            self.next += 1
+            order = self.urls[start:] + self.urls[:start]
+
+            url = min([url for url in order if url in candidates], key=lambda url: self.outstanding[url])
+            self.outstanding[url] += 1
+            return url
+
+    def release(self, url, healthy=True):
+        with self.lock:
+            self.outstanding[url] -= 1
+        if not healthy:
+            self.eject(url)
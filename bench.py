@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+
+# Benchmarks kcing end to end without touching kernelci.org or a real ELK stack.
+#
+# It starts local stand-ins for KernelCI (csrf page and _ajax/boot, _ajax/build listings),
+# storage.kernelci.org, ElasticSearch and the three Logstash http inputs, then runs
+# `feed_es`, `gen_samples`, `setup_kbn` and `drp` as subprocesses against them for every
+# corpus size and latency asked for, reporting docs/s, bytes/s and peak RSS of each run.
+#
+#   ./bench.py --sizes 100 1000 --latencies 0 0.05
+#   ./bench.py --samples-dir samples --feed-args="--direct"
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import dirname, join, realpath
+from urllib.parse import urlparse, parse_qs
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+stdout_logger = logging.StreamHandler()
+stdout_logger.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s@%(funcName)s: %(message)s'))
+logger.addHandler(stdout_logger)
+
+kcing_dir = dirname(realpath(__file__))
+csrf_token = 'kcing-bench-token'
+lab_name = 'lab-bench'
+board = 'bench-board'
+
+# Only a few distinct files are generated, storage serves them round robin stamped with each oid
+variants = 8
+
+
+class Stats(object):
+    """Traffic seen by all stand-ins, shared by every handler thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.docs = 0
+            self.files = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.requests = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+
+class Corpus(object):
+    """Synthetic kernelci listing plus the lava/build files storage serves for it"""
+
+    def __init__(self, size, log_lines=200, samples_dir=None):
+        now = datetime.utcnow()
+        self.docs = {'lava': [], 'build': []}
+        for _type in self.docs.keys():
+            for i in range(size):
+                oid = '%024x' % (random.getrandbits(96))
+                created_on = now - timedelta(seconds=(size - i) * 60 * 60 * 24 / size)
+                self.docs[_type].append({
+                    '_id': {'$oid': oid},
+                    'created_on': {'$date': int(created_on.timestamp() * 1000)},
+                    'file_server_resource': 'bench/%s/%s' % (_type, oid),
+                    'lab_name': lab_name,
+                    'board': board,
+                })
+
+        self.files = {'lava': [], 'build': []}
+        if samples_dir:
+            self._load_samples(samples_dir)
+
+        for n in range(variants):
+            if len(self.files['lava']) < variants:
+                self.files['lava'].append(self._lava(n, log_lines).encode())
+            if len(self.files['build']) < variants:
+                self.files['build'].append(self._build(n).encode())
+
+    def _load_samples(self, samples_dir):
+        for f in sorted(os.listdir(samples_dir)):
+            match = re.match(r'^(lava|build)_.*\.json$', f)
+            if match:
+                with open(join(samples_dir, f), 'rb') as fh:
+                    self.files[match.group(1)].append(fh.read())
+
+        logger.info('Loaded %i lavas and %i builds from %s' % (len(self.files['lava']), len(self.files['build']), samples_dir))
+
+    def _lava(self, n, log_lines):
+        metadata = {
+            'git.commit': '%040x' % (n), 'git.branch': 'master', 'git.describe': 'v5.0-%i' % (n),
+            'kernel.tree': 'mainline', 'kernel.version': 'v5.0-%i' % (n), 'kernel.defconfig': 'defconfig',
+            'job.build_environment': 'gcc-8', 'device.type': board, 'job.arch': 'arm',
+            'job.file_server_resource': 'mainline/master/v5.0-%i/arm/defconfig/gcc-8' % (n),
+            'platform.mach': 'bench', 'kernel.endian': 'little', 'platform.name': board,
+        }
+        definition = 'metadata:\n' + ''.join('  %s: %s\n' % (k, v) for k, v in metadata.items())
+        results = ''.join(
+            "- {name: test-%i, result: %s, measurement: %i, unit: seconds, suite: lava, level: '1.%i', "
+            "logged: '2019-02-13 10:15:40.437371+00:00', log_start_line: %i, log_end_line: %i, id: %i}\n"
+            % (i, 'pass' if i % 7 else 'fail', i, i, i, i + 1, i) for i in range(log_lines // 10 + 1))
+        results += "- {name: auto-login-action, result: pass, measurement: 4.2, unit: seconds}\n"
+        log = ''.join("- {dt: '2019-02-13T10:15:40.437371', lvl: target, msg: 'bench line %i of job %i'}\n"
+                      % (i, n) for i in range(log_lines))
+        return json.dumps({
+            'id': 1000 + n, 'lab_name': lab_name, 'status': 'Complete', 'status_string': 'complete',
+            'results': {'0_lava': results}, 'log': log, 'definition': definition,
+        })
+
+    def _build(self, n):
+        return json.dumps({
+            'job': 'mainline', 'git_branch': 'master', 'kernel': 'v5.0-%i' % (n), 'arch': 'arm',
+            'defconfig_full': 'defconfig', 'build_environment': 'gcc-8', 'build_result': 'PASS',
+            'build_time': 42.0 + n, 'build_log': 'build.log', 'compiler_version_full': 'gcc version 8',
+        })
+
+    def page(self, _type, skip, limit, sort_order):
+        docs = self.docs[_type] if sort_order > 0 else list(reversed(self.docs[_type]))
+        return docs[skip:skip + limit]
+
+    def file(self, _type, oid):
+        # Stamp the oid in, otherwise kcing would skip most files as duplicates of a handful of variants
+        files = self.files[_type]
+        content = files[int(oid, 16) % len(files)]
+        return content.replace(b'{', b'{"bench_oid": "%s", ' % (oid.encode()), 1)
+
+
+def _handler(name, routes, stats, latency):
+    """Build a handler class dispatching `routes` (method, regex) -> function(handler, match, body)"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _dispatch(self, method):
+            body = b''
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                body = self.rfile.read(length)
+
+            if latency:
+                time.sleep(latency)
+
+            stats.add(requests=1, bytes_in=len(body))
+            for (route_method, route), func in routes.items():
+                match = re.match(route, self.path)
+                if route_method == method and match:
+                    status, content, content_type = func(self, match, body)
+                    break
+            else:
+                status, content, content_type = 404, b'{"error": "no route to %s"}' % (self.path.encode()), 'application/json'
+
+            stats.add(bytes_out=len(content))
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            if method != 'HEAD':
+                self.wfile.write(content)
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_HEAD(self):
+            self._dispatch('HEAD')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+        def do_DELETE(self):
+            self._dispatch('DELETE')
+
+    Handler.__name__ = '%sHandler' % (name)
+    return Handler
+
+
+class StandIns(object):
+    """All fake services, each on its own ephemeral port"""
+
+    def __init__(self, stats, latency=0):
+        self.stats = stats
+        self.latency = latency
+        self.corpus = None
+        self.indices = set()
+        self.servers = {}
+
+    def _json(self, obj, status=200):
+        return status, json.dumps(obj).encode(), 'application/json'
+
+    # KernelCI
+    def _csrf(self, handler, match, body):
+        html = '<html><head><meta name="csrf-token" content="%s"></head></html>' % (csrf_token)
+        return 200, html.encode(), 'text/html'
+
+    def _listing(self, handler, match, body):
+        if handler.headers.get('x-csrftoken') != csrf_token:
+            return self._json({'error': 'csrf token missing'}, 403)
+
+        params = parse_qs(urlparse(handler.path).query)
+        _type = 'lava' if match.group(1) == 'boot' else 'build'
+        skip = int(params.get('skip', [0])[0])
+        limit = int(params.get('limit', [1000])[0])
+        sort_order = int(params.get('sort_order', [1])[0])
+        return self._json({'result': self.corpus.page(_type, skip, limit, sort_order)})
+
+    # storage.kernelci.org
+    def _storage(self, handler, match, body):
+        content = self.corpus.file(match.group(1), match.group(2))
+        self.stats.add(files=1)
+        return 200, content, 'application/json'
+
+    # Logstash http inputs
+    def _logstash(self, handler, match, body):
+        if 'ndjson' in (handler.headers.get('Content-Type') or ''):
+            docs = len([line for line in body.splitlines() if line.strip()])
+        else:
+            docs = 1
+        self.stats.add(docs=docs)
+        return 200, b'ok', 'text/plain'
+
+    def _ls_ping(self, handler, match, body):
+        return 200, b'ok', 'text/plain'
+
+    def _ls_stats(self, handler, match, body):
+        return self._json({'jvm': {'mem': {'heap_used_percent': 10}}, 'pipelines': {'kcing': {'queue': {'events_count': 0}}}})
+
+    # ElasticSearch
+    def _es_ping(self, handler, match, body):
+        return self._json({'name': 'kcing-bench', 'version': {'number': '7.0.0'}})
+
+    def _bulk(self, handler, match, body):
+        lines = body.splitlines()
+        items = []
+        for action in lines[0::2]:
+            action = json.loads(action)
+            op, meta = list(action.items())[0]
+            self.indices.add(meta['_index'])
+            items.append({op: {'_index': meta['_index'], 'status': 201}})
+        self.stats.add(docs=len(items))
+        return self._json({'took': 1, 'errors': False, 'items': items})
+
+    def _mget(self, handler, match, body):
+        ids = json.loads(body)['ids']
+        return self._json({'docs': [{'_index': match.group(1), '_id': _id, 'found': False} for _id in ids]})
+
+    def _kibana_alias(self, handler, match, body):
+        return self._json({'.kibana_1': {'aliases': {'.kibana': {}}}})
+
+    def _put_doc(self, handler, match, body):
+        self.stats.add(docs=1)
+        return self._json({'_id': match.group(1), 'result': 'created'}, 201)
+
+    def _ack(self, handler, match, body):
+        return self._json({'acknowledged': True})
+
+    def _cat_indices(self, handler, match, body):
+        lines = ['green open %s xxxx 1 0 1 0 1kb 1kb' % (index) for index in sorted(self.indices)]
+        return 200, ('\n'.join(lines) + '\n').encode(), 'text/plain'
+
+    def _delete_indices(self, handler, match, body):
+        self.indices -= set(match.group(1).split(','))
+        return self._ack(handler, match, body)
+
+    def _serve(self, name, routes):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _handler(name, routes, self.stats, self.latency))
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.servers[name] = server
+        return 'http://127.0.0.1:%i' % (server.server_address[1])
+
+    def start(self):
+        routes = {
+            'kci': {
+                ('GET', r'^/?$'): self._csrf,
+                ('GET', r'^/_ajax/(boot|build)\?'): self._listing,
+            },
+            'storage': {
+                ('GET', r'^/bench/(lava|build)/([0-9a-f]+)/'): self._storage,
+            },
+            'es': {
+                ('GET', r'^/?$'): self._es_ping,
+                ('HEAD', r'^/?$'): self._es_ping,
+                ('POST', r'^/_bulk'): self._bulk,
+                ('PUT', r'^/_template/'): self._ack,
+                ('PUT', r'^/\.kibana[^/]*/_doc/([^/?]+)'): self._put_doc,
+                ('POST', r'^/(\.kibana[^/]*)/_mget'): self._mget,
+                ('GET', r'^/_alias/\.kibana$'): self._kibana_alias,
+                ('GET', r'^/_cat/indices'): self._cat_indices,
+                ('DELETE', r'^/([^/?_][^/?]*)$'): self._delete_indices,
+            },
+            'ls_api': {
+                ('GET', r'^/_node/stats'): self._ls_stats,
+            },
+        }
+
+        urls = {name: self._serve(name, r) for name, r in routes.items()}
+        for name in ['ls_lava', 'ls_build', 'ls_boot']:
+            urls[name] = self._serve(name, {('POST', r'^/'): self._logstash, ('GET', r'^/'): self._ls_ping})
+
+        return urls
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+
+def _env(urls, work_dir):
+    env = dict(os.environ)
+    env.update({
+        'KCI_SCHEME': 'http',
+        'KCI_HOST': urls['kci'].replace('http://', ''),
+        'KCI_STORAGE_URL': urls['storage'],
+        'ES_HOST': urls['es'],
+        'ES_LAVA': urls['ls_lava'],
+        'ES_BUILD': urls['ls_build'],
+        'ES_BOOT': urls['ls_boot'],
+        'LS_API': urls['ls_api'],
+        'KCING_DB': join(work_dir, 'kcing.db'),
+        'KCING_DATA_DIR': join(work_dir, 'data'),
+    })
+    return env
+
+
+def _run(cmd, env, log_file):
+    """Run a kcing command, returns (exit code, seconds, peak rss in KiB)"""
+    with open(log_file, 'a') as fh:
+        start = time.time()
+        process = subprocess.Popen([sys.executable, join(kcing_dir, 'kcing.py')] + cmd,
+                                   cwd=kcing_dir, env=env, stdout=fh, stderr=subprocess.STDOUT)
+
+        # wait4 reports resource usage of that very child, RUSAGE_CHILDREN would add up all runs so far
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, elapsed, usage.ru_maxrss
+
+
+def bench(args):
+    results = []
+    for latency in args.latencies:
+        stats = Stats()
+        stand_ins = StandIns(stats, latency=latency)
+        urls = stand_ins.start()
+
+        try:
+            for size in args.sizes:
+                stand_ins.corpus = Corpus(size, log_lines=args.log_lines, samples_dir=args.samples_dir)
+                work_dir = tempfile.mkdtemp(prefix='kcing-bench-')
+                env = _env(urls, work_dir)
+                os.makedirs(env['KCING_DATA_DIR'])
+                log_file = join(work_dir, 'kcing.log')
+
+                cmds = {
+                    'feed_es': ['feed_es'] + args.feed_args.split(),
+                    'gen_samples': ['gen_samples', '--samples-dir', join(work_dir, 'samples')],
+                    'setup_kbn': ['setup_kbn'],
+                    'drp': ['drp', '--drp-days', '0'],
+                }
+                os.makedirs(join(work_dir, 'samples'))
+
+                for name in args.cmds:
+                    stats.reset()
+                    logger.info('Running %s with %i lavas/builds and %.3fs of latency' % (name, size, latency))
+                    rc, elapsed, rss = _run(cmds[name], env, log_file)
+
+                    # Downloading samples doesn't post anything, count files served instead
+                    docs = stats.files if name == 'gen_samples' else stats.docs
+                    result = {
+                        'cmd': name,
+                        'size': size,
+                        'latency': latency,
+                        'rc': rc,
+                        'seconds': round(elapsed, 3),
+                        'docs': docs,
+                        'bytes': stats.bytes_in + stats.bytes_out,
+                        'requests': stats.requests,
+                        'docs_per_sec': round(docs / elapsed, 1),
+                        'bytes_per_sec': round((stats.bytes_in + stats.bytes_out) / elapsed, 1),
+                        'peak_rss_kb': rss,
+                    }
+                    results.append(result)
+
+                    if rc != 0:
+                        logger.error('%s exited with %i, see %s' % (name, rc, log_file))
+
+                if args.keep:
+                    logger.info('Kept %s' % (work_dir))
+                else:
+                    shutil.rmtree(work_dir)
+        finally:
+            stand_ins.stop()
+
+    return results
+
+
+def _report(results):
+    columns = ['cmd', 'size', 'latency', 'rc', 'seconds', 'docs', 'docs_per_sec', 'bytes_per_sec', 'peak_rss_kb']
+    rows = [columns] + [[str(r[c]) for c in columns] for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def main(args):
+    random.seed(args.seed)
+    results = bench(args)
+    _report(results)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        logger.info('Results saved to %s' % (args.json))
+
+    return 0 if all(r['rc'] == 0 for r in results) else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark kcing against local KernelCI, storage, ES and Logstash stand-ins')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+                        help='Number of lavas and builds listed by the fake KernelCI, one run per size')
+    parser.add_argument('--latencies', type=float, nargs='+', default=[0, 0.05],
+                        help='Seconds every stand-in waits before answering, one run per latency')
+    parser.add_argument('--cmds', nargs='+', choices=['feed_es', 'gen_samples', 'setup_kbn', 'drp'],
+                        default=['feed_es', 'gen_samples', 'setup_kbn', 'drp'],
+                        help='kcing commands to benchmark, in order')
+    parser.add_argument('--feed-args', default='',
+                        help='Extra args passed to feed_es, e.g. --feed-args="--direct --stream"')
+    parser.add_argument('--samples-dir',
+                        help='Serve lava/build files from this directory (see gen_samples) instead of synthetic ones')
+    parser.add_argument('--log-lines', type=int, default=200,
+                        help='Log lines of each synthetic lava file')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed used to generate the corpus')
+    parser.add_argument('--json',
+                        help='Also save results to this json file')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep databases, data and logs of each run')
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -3,49 +3,77 @@
 # Takes Kernelci lavas/builds, send them to ES and save to a local sqlite
 # db, data should not be duplicated in ES
 
+import hashlib
+import json
 import logging
 import re
 import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-import requests
-from os.path import isfile, isdir, dirname, join
+from functools import partial
+from itertools import zip_longest
+from os.path import isfile, isdir, dirname, join, getmtime, getsize, basename
 from os import listdir, unlink, makedirs
 
 import settings
 import samples
+import metrics
 import models
+import templates
+import transport
+import lava
+from backpressure import Backpressure
+from esbulk import bulk
+from balancer import Balancer, split_urls
+from errors import CannotContinue
 from kernelci import KernelCI
 
 logger = logging.getLogger()
 
-data_dir = join(dirname(__file__), 'data')
-client = None
+data_dir = settings.KCING_DATA_DIR
 leftovers = None
+
+# (index, count) of the slice of kernelci oids this worker handles, see --shard
+shard = None
 es_host = settings.ES_HOST
 es_urls = {
-    'lava': settings.ES_LAVA,
-    'build': settings.ES_BUILD,
-    'boot': settings.ES_BOOT,
+    'lava': split_urls(settings.ES_LAVA),
+    'build': split_urls(settings.ES_BUILD),
+    'boot': split_urls(settings.ES_BOOT),
 }
+balancers = {}
 
 
 class fake_args(object):
     sample_size = -1
+    stream = False
+    full_scan = False
+    direct = False
+    shard = None
 
 
 def _client():
-    global client
-    if client is None:
-        client = requests.session()
-        client.headers['Connection'] = 'keep-alive'
+    return transport.client()
+
 
-    return client
+def _balancer(_type):
+    """Logstash nodes taking _type documents, see ES_LAVA, ES_BUILD and ES_BOOT"""
+    if _type not in balancers:
+        balancers[_type] = Balancer(es_urls[_type], _is_ls_ok)
+    return balancers[_type]
 
 
 def _load_leftovers(path=data_dir):
     global leftovers
     leftovers = {'lava': {}, 'build': {}, 'boot': {}}
     for f in listdir(path):
+        if f.endswith(samples.part_suffix):
+            _remove_stale_part(join(path, f))
+            continue
+
         if f.startswith('lava_'):
             _type = 'lava'
         elif f.startswith('build_'):
@@ -62,24 +90,75 @@ def _load_leftovers(path=data_dir):
 
     return leftovers
 
-def _download(_type, objs, path=data_dir):
 
-    # Get whatever lava/build previously downloaded
-    # but yet not successfully posted to ES
-    _load_leftovers(path)
-    downloads = leftovers[_type] # [_id] = (build|lava|boot)_id.json
-    logger.debug('%i %s files are already downloaded' % (len(downloads), _type))
-
-    # Also, get a list of objects that were posted successfully
-    processed = models.all_objs(_type)
- 
+def _set_shard(value):
+    global shard
+    shard = value
+    if shard is not None:
+        logger.info('Working on shard %i/%i of kernelci objects' % (shard[0], shard[1]))
+
+
+def _in_shard(oid):
+    """Whether oid belongs to this worker, workers running with --shard i/N split oids by their crc32"""
+    if shard is None:
+        return True
+    return zlib.crc32(oid.encode()) % shard[1] == shard[0]
+
+
+def _shard_objs(objs):
+    return {_id: objs[_id] for _id in objs if _in_shard(_id)}
+
+
+def _remove_stale_part(file_name, max_age=60 * 60):
+    """Remove partial downloads left behind by killed runs"""
+    try:
+        if time.time() - getmtime(file_name) > max_age:
+            unlink(file_name)
+            logger.info('Removed stale partial download %s' % (file_name))
+    except OSError as e:
+        logger.warning('Could not remove %s: %s' % (file_name, e))
+
+
+def _download(_type, objs, path=data_dir, with_leftovers=True):
     # When _type is 'lava', there might be boots as well
-    if _type == 'lava':
-        processed.update(models.all_objs('boot'))
+    types = ['lava', 'boot'] if _type == 'lava' else [_type]
 
-    # Filter objs, removing ones already downloaded or processed
+    # Get whatever lava/build previously downloaded
+    # but yet not successfully posted to ES, unless it's
+    # still waiting for its next attempt
+    downloads = {}
+    if with_leftovers:
+        _load_leftovers(path)
+        downloads = leftovers[_type] # [_id] = (build|lava|boot)_id.json
+        for _id in models.pending_failures(types, 'post', downloads.keys()):
+            del downloads[_id]
+        logger.debug('%i %s files are already downloaded' % (len(downloads), _type))
+    else:
+        # Without scanning `path`, files that failed to be sent come from kcing.db
+        for t in types:
+            due = models.due_failures(t, 'post')
+            downloads.update({_id: due[_id] for _id in due if isfile(join(path, due[_id]))})
+
+    # Previous failed downloads go first
+    retries = models.due_failures(_type, 'download')
+    if len(retries):
+        logger.info('Retrying %i %s files that previously failed to download' % (len(retries), _type))
+    objs = dict(retries, **objs)
+
+    # Other workers take care of the rest of kernelci objects, even if they share `path`
+    if shard is not None:
+        listed = len(objs)
+        objs = _shard_objs(objs)
+        downloads = _shard_objs(downloads)
+        logger.info('%i out of %i %s files belong to shard %i/%i' % (len(objs), listed, _type, shard[0], shard[1]))
+
+    # Filter objs, removing ones already downloaded, processed or waiting for their next attempt
     fresh_ids = objs.keys() - downloads.keys()
-    fresh_ids -= processed
+    fresh_ids -= models.existing(types, fresh_ids)
+    fresh_ids -= models.pending_failures([_type], 'download', fresh_ids)
+
+    # Posts backing off or given up would otherwise be downloaded and sent again every time they're listed
+    fresh_ids -= models.pending_failures(types, 'post', fresh_ids)
 
     fresh_objs = {}
     for _id in fresh_ids:
@@ -88,6 +167,11 @@ def _download(_type, objs, path=data_dir):
     logger.info('Downloading %i %s files' % (len(fresh_objs), _type))
     saved, failed = samples._persist_samples(_type, fresh_objs, path)
 
+    # Keep track of failures so they can be retried later
+    models.clear_failures(_type, 'download', saved.keys())
+    for _id in models.record_failures(_type, 'download', failed):
+        logger.error('Giving up on downloading %s after %i attempts' % (failed[_id], settings.KCING_MAX_ATTEMPTS))
+
     # Merge recent downloads with leftover downloads
     logger.info('%i %s files successfully downloaded and %i failed' % (len(saved), _type, len(failed)))
     downloads.update(saved)
@@ -103,29 +187,60 @@ def _is_data_dir_ok(path=data_dir):
         return False
 
 
-def _is_es_ok():
+def _is_es_ok(direct=False):
     logger.info('Checking ES health')
 
-    for url in es_urls.values():
+    # Direct mode talks to ES itself, there's no logstash involved
+    if direct:
         try:
-            logger.debug('Pinging "%s"' % (url))
-            response = _client().get(url)
+            logger.debug('Pinging "%s"' % (es_host))
+            response = _client().get(es_host)
         except:
-            logger.error('Cannot reach "%s"' % (url))
+            logger.error('Cannot reach "%s"' % (es_host))
             return False
 
         if response.status_code != 200:
-            logger.error('GET "%s" did not return 200, instead returned %i' % (url, response.status_code))
+            logger.error('GET "%s" did not return 200, instead returned %i' % (es_host, response.status_code))
             return False
 
-        if response.content.decode() != 'ok':
-            logger.error('GET "%s" did not return "ok", instead returned "%s"' % (url, response.content.decode()))
+        logger.info('ES seems to be online')
+        return True
+
+    # A dead logstash node is fine, as long as others can take its documents
+    for _type in es_urls.keys():
+        balancer = _balancer(_type)
+        healthy = balancer.check_all()
+        if healthy == 0:
+            logger.error('None of %s logstash nodes is healthy' % (_type))
             return False
 
+        if healthy < len(balancer):
+            logger.warning('%i out of %i %s logstash nodes are healthy' % (healthy, len(balancer), _type))
+
     logger.info('ES seems to be online')
     return True
 
 
+def _is_ls_ok(url):
+    """Whether a logstash node is up and its http input answers "ok" """
+    try:
+        logger.debug('Pinging "%s"' % (url))
+        response = _client().get(url, retries=0)
+    except:
+        logger.error('Cannot reach "%s"' % (url))
+        return False
+
+    if response.status_code != 200:
+        logger.error('GET "%s" did not return 200, instead returned %i' % (url, response.status_code))
+        return False
+
+    if response.content.decode() != 'ok':
+        logger.error('GET "%s" did not return "ok", instead returned "%s"' % (url, response.content.decode()))
+        return False
+
+    return True
+
+
 def _unlink_successfull_objs(objs, path=data_dir):
     unlinked = 0
     for _id in objs.keys():
@@ -137,6 +252,82 @@ def _unlink_successfull_objs(objs, path=data_dir):
     logger.info('Removed %i objects' % (unlinked))
 
 
+def _oid(file_name):
+    """Kernelci id of a downloaded lava/build/boot file, None if it's not named after one"""
+    match = re.match(r'^(lava|build|boot)_([0-9a-f]+)\.json$', basename(file_name))
+    return match.group(2) if match else None
+
+
+def _post_content(_type, content, headers=None, what='data', oid=None, idempotent=False):
+    """
+    Post content to logstash, it can be either a string or a file object to stream from.
+    Documents of a single file posted along with their kernelci `oid` get deterministic ids,
+    those and `idempotent` content can be posted again if it's not clear they made it.
+    When a logstash node is down or busy, the next healthy one is tried. Returns None,
+    rather than False, if there was no node to even try
+    """
+    balancer = _balancer(_type)
+    position = content.tell() if hasattr(content, 'tell') else 0
+
+    # Let the pipeline know how many log lines go in each log document, see KCING_LOG_CHUNK
+    params = {}
+    if _type == 'lava' and settings.KCING_LOG_CHUNK > 0:
+        params['log_chunk'] = settings.KCING_LOG_CHUNK
+    if oid is not None:
+        params['kcing_id'] = oid
+
+    tried = []
+    while True:
+        es_url = balancer.acquire(exclude=tried)
+        if es_url is None and len(tried) == 0:
+            logger.error('Could not post %s, no %s logstash node available' % (what, _type))
+            return None
+
+        if es_url is None:
+            logger.error('Failed to post %s, no %s logstash node left to try' % (what, _type))
+            metrics.inc('kcing_posts_total', type=_type, result='failed')
+            return False
+        tried.append(es_url)
+
+        # Failing over is quicker than retrying the same node, unless it's the last one left
+        last = len(balancer.healthy(exclude=tried)) == 0
+        retries = settings.ES_MAX_RETRIES - 1 if last else 0
+
+        if hasattr(content, 'seek'):
+            content.seek(position)
+
+        try:
+            logger.debug('Sending %s to %s' % (what, es_url))
+            with metrics.timer('kcing_post_seconds', type=_type):
+                response = _client().post(es_url, data=content, headers=headers, params=params, retries=retries, idempotent=idempotent or oid is not None)
+        except:
+            balancer.release(es_url, healthy=False)
+            logger.error('Failed to post %s to %s due to connection issues' % (what, es_url))
+            continue
+
+        # Busy or broken nodes are ejected, anything else is about the content and would fail anywhere
+        if response.status_code in transport.retry_statuses or response.status_code >= 500:
+            balancer.release(es_url, healthy=False)
+            logger.error('Failed to post %s to %s, response returned %i' % (what, es_url, response.status_code))
+            continue
+
+        balancer.release(es_url)
+        break
+
+    if response.status_code != 200:
+        logger.error('Failed to post %s to %s, response returned %i' % (what, es_url, response.status_code))
+        metrics.inc('kcing_posts_total', type=_type, result='failed')
+        return False
+
+    if response.content.decode() != 'ok':
+        logger.error('Something went wrong while posting, expected "ok", got instead "%s"' % (response.content.decode()))
+        metrics.inc('kcing_posts_total', type=_type, result='failed')
+        return False
+
+    metrics.inc('kcing_posts_total', type=_type, result='ok')
+    return True
+
+
 def _post(_type, file_name, path=data_dir):
     if dirname(file_name) == '':
         file_name = join(path, file_name) 
@@ -145,47 +336,266 @@ def _post(_type, file_name, path=data_dir):
         logger.error('Object %s is not a valid file' % (file_name))
         return False
 
-    es_url = es_urls[_type]
+    # Stream it straight from disk, instead of holding the whole file in memory
+    with open(file_name, 'rb') as file_handler:
+        return _post_content(_type, file_handler, what=file_name, oid=_oid(file_name))
 
-    file_content = ''
-    with open(file_name, 'r') as file_handler:
-        file_content = file_handler.read()
 
-    try:
-        logger.debug('Sending %i bytes to %s' % (len(file_content), es_url))
-        response = _client().post(es_url, data=file_content)
-    except:
-        logger.error('Failed to post to %s to %s due to connection issues' % (file_name, es_url))
+def _post_batch(_type, lines, path=None, idempotent=False):
+    """
+    Post several documents at once as newline-delimited json, see `json_lines` codec in kcing_pipeline.conf.
+    Batches are `idempotent` when all their documents carry a `kcing_id`
+    """
+    content = '\n'.join(lines) + '\n'
+    headers = {'Content-Type': 'application/x-ndjson'}
+    return _post_content(_type, content, headers=headers, what='batch of %i %ss' % (len(lines), _type), idempotent=idempotent)
+
+
+def _send(_type, obj, path=data_dir, post=_post):
+    # Connection errors and busy responses are already retried, with backoff, by transport.
+    # Anything else won't get any better by trying again right away, kcing.db retries it on later runs.
+    # None means it wasn't even tried
+    result = post(_type, obj, path)
+    if result or result is None:
+        return result
+
+    logger.error('Failed to send %s data to ES' % (_type))
+    return False
+
+
+def _index_docs(_type, docs, path=None, oid=None):
+    """Index documents from lava.transform straight to ES, with deterministic ids when `oid` is known"""
+    if docs is None:
         return False
 
-    if response.status_code != 200:
-        logger.error('Failed to post %s to %s, response returned %i' % (es_url, response.status_code))
+    actions = [{'_index': index} for index, doc in docs]
+    if oid is not None:
+        for action, _id in zip(actions, lava.doc_ids(oid, docs)):
+            action['_id'] = _id
+
+    errors = bulk([(action, doc) for action, (index, doc) in zip(actions, docs)])
+    if errors is None:
         return False
 
-    if response.content.decode() != 'ok':
-        logger.error('Something went wrong while posting, expected "ok", got instead "%s"' % (response.content.decode()))
+    if len(errors):
+        logger.error('ES failed to index %i out of %i %s documents, first error: %s' % (len(errors), len(docs), _type, errors[0]['error']))
         return False
 
     return True
 
 
-def _send(_type, obj, path=data_dir):
-    result = _post(_type, obj, path)
+def _index(_type, file_name, path=data_dir):
+    """Transform a lava/build/boot file like kcing_pipeline.conf does and index it straight to ES"""
+    if dirname(file_name) == '':
+        file_name = join(path, file_name)
 
-    if result:
-        return True
+    return _index_docs(_type, lava.transform_file(_type, file_name), oid=_bulk_oid(file_name))
 
-    attempts = 1
-    while attempts < settings.ES_MAX_RETRIES:
-        if _post(_type, obj, path):
-            return True
-        attempts += 1
 
-    logger.error('Exceeded number of attempts (%i) to send data to logstash' % (settings.ES_MAX_RETRIES))
-    return False
+def _bulk_oid(file_name, path=data_dir):
+    """
+    Base of the ids of documents indexed out of file_name. Files not named after their kernelci
+    id use their digest instead, so that chunks already indexed before a failure are overwritten,
+    instead of duplicated, when the file is sent again
+    """
+    return _oid(file_name) or _digest(file_name, path)
+
+
+def _index_all(_type, objs, path=data_dir):
+    """
+    Transform lava files in a pool of KCING_TRANSFORM_WORKERS processes, yaml parsing
+    is way too heavy for a single core. Transformed files are indexed as they
+    come back, in order, yielding a list of ids along with the result of each one
+    """
+    workers = settings.KCING_TRANSFORM_WORKERS
+
+    # Keep a bounded number of transformed files waiting to be indexed, otherwise they'd pile up in memory
+    executor = ProcessPoolExecutor(max_workers=workers)
+    in_flight = deque()
+    ids = iter(objs)
+    try:
+        while True:
+            for _id in ids:
+                file_name = objs[_id]
+                if dirname(file_name) == '':
+                    file_name = join(path, file_name)
+                in_flight.append((_id, executor, executor.submit(lava.transform_file, _type, file_name)))
+                if len(in_flight) >= 2 * workers:
+                    break
+
+            if len(in_flight) == 0:
+                break
+
+            _id, submitted_to, future = in_flight.popleft()
+            try:
+                docs = future.result()
+            except BrokenProcessPool:
+                # A worker died, taking every file in flight with it. Those are counted as failed
+                # as they come out, the ones left get a new pool
+                logger.error('Transform worker died while on %s' % (objs[_id]))
+                if submitted_to is executor:
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=workers)
+                yield [_id], False
+                continue
+            except:
+                logger.error('Failed to transform %s' % (objs[_id]))
+                yield [_id], False
+                continue
+
+            yield [_id], _send(_type, docs, post=partial(_index_docs, oid=_bulk_oid(objs[_id], path)))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _read_line(file_name, path=data_dir):
+    """
+    Read a json file as a single line, returns None if it's not a valid json document.
+    Batched documents carry their kernelci id in `kcing_id`, so they get deterministic ids
+    """
+    oid = _oid(file_name)
+    if dirname(file_name) == '':
+        file_name = join(path, file_name)
+
+    try:
+        with open(file_name, 'r') as file_handler:
+            doc = json.load(file_handler)
+    except (OSError, ValueError):
+        return None
+
+    if oid is not None and isinstance(doc, dict):
+        doc['kcing_id'] = oid
+    return json.dumps(doc, separators=(',', ':'))
+
+
+def _send_batches(_type, objs, path=data_dir):
+    """
+    Send objs in batches capped by ES_BATCH_SIZE documents and ES_BATCH_BYTES bytes,
+    yields a list of ids along with the result of every request made
+    """
+    def post_batch(batch):
+        with_ids = all(_oid(objs[_id]) is not None for _id in batch)
+        return _send(_type, list(batch.values()), post=partial(_post_batch, idempotent=with_ids))
+
+    batch = {}
+    size = 0
+    for _id in objs:
+        line = _read_line(objs[_id], path)
+        if line is None:
+            # Leave it to the regular path, so errors are reported per file
+            yield [_id], _send(_type, objs[_id], path)
+            continue
+
+        if len(batch) and (len(batch) >= settings.ES_BATCH_SIZE or size + len(line) > settings.ES_BATCH_BYTES):
+            yield list(batch.keys()), post_batch(batch)
+            batch = {}
+            size = 0
+
+        batch[_id] = line
+        size += len(line)
+
+    if len(batch):
+        yield list(batch.keys()), post_batch(batch)
+
+
+def _send_concurrently(_type, objs, path=data_dir, drained=None):
+    """
+    Send objs to as many logstash nodes as there are at the same time, yielding
+    a list of ids along with the result of each one, in order. When closed before
+    the end (e.g. aborting), objs still in flight are waited for and their results
+    left in `drained`, they might have made it to logstash already
+    """
+    workers = len(_balancer(_type))
+
+    def result(_id, future):
+        try:
+            return future.result()
+        except:
+            logger.error('Failed to send %s' % (objs[_id]))
+            return False
+
+    # Only a few objs are in flight at a time, so that backpressure still slows sending down
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        ids = iter(objs)
+        try:
+            while True:
+                for _id in ids:
+                    in_flight.append((_id, executor.submit(_send, _type, objs[_id], path)))
+                    if len(in_flight) >= workers:
+                        break
+
+                if len(in_flight) == 0:
+                    break
+
+                _id, future = in_flight.popleft()
+                yield [_id], result(_id, future)
+        finally:
+            for _id, future in in_flight:
+                if drained is not None:
+                    drained[_id] = result(_id, future)
+
+
+def _size(file_name, path=data_dir):
+    """Size of a file in bytes, 0 if it can't be read"""
+    if dirname(file_name) == '':
+        file_name = join(path, file_name)
+
+    try:
+        return getsize(file_name)
+    except OSError:
+        return 0
+
+
+def _digest(file_name, path=data_dir):
+    """sha256 of a file's content, None if it can't be read"""
+    if dirname(file_name) == '':
+        file_name = join(path, file_name)
 
+    digest = hashlib.sha256()
+    try:
+        with open(file_name, 'rb') as file_handler:
+            for chunk in iter(lambda: file_handler.read(samples.chunk_size), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def _dedup(_type, objs, path=data_dir):
+    """
+    Split objs into the ones worth sending and the ones whose content was already sent to ES
+    under another oid, either in a previous run or by another obj of objs.
+    Returns (objs to send, {duplicate oid: original oid}, {oid to send: digest})
+    """
+    digests = {_id: _digest(objs[_id], path) for _id in objs}
+    sent = models.ingested(_type, set(digests.values()) - {None})
+
+    fresh = {}
+    duplicates = {}
+    for _id in objs:
+        digest = digests[_id]
+        original = sent.get(digest)
+        if digest is not None and original is not None and original != _id:
+            duplicates[_id] = original
+            continue
 
-def _send_to_es(_type, objs, path=data_dir):
+        fresh[_id] = objs[_id]
+        if digest is not None:
+            sent[digest] = _id
+
+    for _id in duplicates:
+        logger.debug('%s has the same content as %s, skipping it' % (objs[_id], duplicates[_id]))
+
+    return fresh, duplicates, {_id: digests[_id] for _id in fresh if digests[_id] is not None}
+
+
+def _backpressure(direct=False):
+    """Logstash load watcher, shared by every send of a feed. Direct mode doesn't go through logstash"""
+    return None if direct else Backpressure(_client())
+
+
+def _send_to_es(_type, objs, path=data_dir, direct=False, throttle=None):
     logger.info('Sending to %i %s pipeline' % (len(objs), _type))
     stats = {True: {}, False: {}}
     passed = stats[True]
@@ -196,84 +606,333 @@ def _send_to_es(_type, objs, path=data_dir):
     lava_batch_size = 10
 
     if cmdline_objs:
-        logger.info('Command line detected! Duplicates might exist for %i %s index' % (len(objs), _type))
+        logger.info('Command line detected! Duplicates might exist for %i %s index, unless files are named %s_<kernelci id>.json' % (len(objs), _type, _type))
         objs = {_id: objs[_id] for _id in range(0, len(objs))}
 
-    for _id in objs:
-        result = _send(_type, objs[_id], path)
-        stats[result][_id] = objs[_id]
+    # Results of objs still being sent when the loop below stops early
+    drained = {}
 
-        # If 3 consecutive fails, Logstash is probably down
+    # Labs resubmitting results make different oids point to the very same content
+    listed_objs = objs
+    duplicates = {}
+    if not cmdline_objs:
+        objs, duplicates, digests = _dedup(_type, objs, path)
+
+    # Builds and boots are small, so pack many of them in a single request.
+    # Lavas are too heavy on logstash to be batched
+    if direct and _type == 'lava' and settings.KCING_TRANSFORM_WORKERS > 1:
+        results = _index_all(_type, objs, path)
+    elif direct:
+        results = (([_id], _send(_type, objs[_id], path, post=_index)) for _id in objs)
+    elif _type != 'lava' and settings.ES_BATCH_SIZE > 1:
+        results = _send_batches(_type, objs, path)
+    elif len(_balancer(_type)) > 1:
+        results = _send_concurrently(_type, objs, path, drained=drained)
+    else:
+        results = (([_id], _send(_type, objs[_id], path)) for _id in objs)
+
+    # Controls amount of load to send logstash
+    if throttle is None:
+        throttle = _backpressure(direct)
+    if throttle:
+        throttle.fallback_every = lava_batch_size if _type == 'lava' else None
+        slept_before = throttle.slept
+
+    started = time.time()
+    for ids, result in results:
+        if throttle:
+            throttle.record(time.time() - started, sum(_size(objs[_id], path) for _id in ids), _type)
+
+        # No logstash node to send them to, these and the ones left are not even attempted
+        if result is None:
+            logger.error('No %s logstash node available, leaving the rest for next run' % (_type))
+            break
+
+        for _id in ids:
+            stats[result][_id] = objs[_id]
+
+        # If 3 consecutive fails and no logstash node is left but the one never ejected, Logstash is probably down
         if not result:
             consecutive_fails = consecutive_fails + 1 if result == result_before else 0
 
-            if consecutive_fails == 3:
+            if consecutive_fails >= 3 and (direct or len(_balancer(_type).healthy()) <= 1):
                 logger.error('Multiple failed attempts to connect to Logstash, aborting...')
-                return passed, failed
+                break
         result_before = result
 
-        # Controls amount of load to send logstash
-        sent = len(passed) + len(failed)
-        if _type == 'lava':
-            if (sent % lava_batch_size) == 0:
-                logger.info('Wait a bit to let logstash digest more %i events. Sleeping for %i seconds' % (10, settings.ES_LOAD_INTERVAL))
-                time.sleep(settings.ES_LOAD_INTERVAL)
+        if throttle:
+            throttle.wait()
+        started = time.time()
+
+    results.close()
+    for _id, result in drained.items():
+        if result is not None:
+            stats[result][_id] = objs[_id]
+
+    metrics.inc('kcing_sent_total', len(passed), type=_type, result='ok')
+    metrics.inc('kcing_sent_total', len(failed), type=_type, result='failed')
 
-    # Save successfull objs and delete the ones processed correctly
+    # Objs left behind by an abort are not recorded anywhere else, later watch cycles
+    # only pick files up from kcing.db, so make them due right away without counting an attempt
+    untried = {_id: objs[_id] for _id in objs if _id not in passed and _id not in failed}
+    if len(untried):
+        logger.info('%i %s files were not sent, they will be on next run' % (len(untried), _type))
+
+    if throttle and throttle.slept > slept_before:
+        logger.info('Waited %.2f seconds for logstash to digest %i %ss' % (throttle.slept - slept_before, len(objs), _type))
+
+    # Save successfull objs and delete the ones processed correctly,
+    # failed ones are left in `path` to be retried later
     if not cmdline_objs:
+        # Duplicates are done once their original content made it to ES, or they'd be lost along with it
+        skipped = {}
+        for _id, original in duplicates.items():
+            if original in passed or original not in objs:
+                skipped[_id] = listed_objs[_id]
+            elif original in failed:
+                failed[_id] = listed_objs[_id]
+            elif original in untried:
+                untried[_id] = listed_objs[_id]
+
+        if len(skipped):
+            logger.info('Skipped %i %s files already sent to ES under another id' % (len(skipped), _type))
+        metrics.inc('kcing_duplicates_total', len(skipped), type=_type)
+
         models.save(_type, passed)
-        _unlink_successfull_objs(passed, path)
-        
+        models.save(_type, skipped)
+        models.save_digests(_type, {_id: digests[_id] for _id in passed if _id in digests})
+        _unlink_successfull_objs(dict(passed, **skipped), path)
+        models.clear_failures(_type, 'post', list(passed.keys()) + list(skipped.keys()))
+        for _id in models.record_failures(_type, 'post', failed):
+            logger.error('Giving up on sending %s after %i attempts' % (failed[_id], settings.KCING_MAX_ATTEMPTS))
+        models.record_failures(_type, 'post', untried, attempted=False)
+
     return passed, failed
             
 
+def _watermarks(args, kci=None):
+    """
+    Get the point in time from which KernelCI should be listed for each type,
+    None means the regular feed_es data size (past 2 days). Listing with `kci`
+    picks the watermarks up from kcing.db, so that they never move backwards
+    """
+    since = {'lava': None, 'build': None}
+    if args.full_scan:
+        logger.info('Full scan requested, sync watermarks are ignored')
+        return since
+
+    # Go back a little bit, just in case docs show up in KernelCI out of order,
+    # anything already processed gets filtered out anyways
+    overlap = timedelta(minutes=settings.KCI_SYNC_OVERLAP)
+    for _type in since.keys():
+        watermark = models.get_watermark(_type)
+        if watermark is not None:
+            since[_type] = watermark[0] - overlap
+            if kci is not None and _type not in kci.newest:
+                kci.newest[_type] = watermark
+
+    return since
+
+
+def _update_watermarks(kci):
+    # Failed downloads are not lost when the watermark moves past them, they're retried from kcing.db
+    for _type, (created_on, oid) in kci.newest.items():
+        if models.get_watermark(_type) == (created_on, oid):
+            continue
+        models.set_watermark(_type, created_on, oid)
+        logger.info('Sync watermark for %s moved to %s (%s)' % (_type, created_on, oid))
+
+
+def _split_boots(lavas):
+    """
+    During download, some lava files might've been switched to boot files
+    so let's just separate them and filter them out of lavas dictonary
+    """
+    boots = {_id: lavas[_id] for _id in lavas.keys() if 'boot' in lavas[_id]}
+    for _id in boots.keys():
+        del lavas[_id]
+    return boots
+
+
+def _send_all(lavas, builds, boots, path=data_dir, direct=False, throttle=None):
+    logger.info('Working on %i lavas, %i builds and %i boots' % (len(lavas), len(builds), len(boots)))
+
+    return {
+        'lava': _send_to_es('lava', lavas, path, direct, throttle),
+        'build': _send_to_es('build', builds, path, direct, throttle),
+        'boot': _send_to_es('boot', boots, path, direct, throttle),
+    }
+
+
+def _feed_stream(kci, how_many=-1, since=None, path=data_dir, direct=False, with_leftovers=True, throttle=None):
+    """
+    Download and send every listing page as soon as KernelCI returns it,
+    instead of waiting for the whole listing to finish
+    """
+    since = since or {}
+    stats = {_type: ({}, {}) for _type in ['lava', 'build', 'boot']}
+
+    def feed_page(builds, lavas, with_leftovers):
+        with metrics.stage('download'):
+            builds = _download('build', builds, path, with_leftovers)
+            lavas = _download('lava', lavas, path, with_leftovers)
+        boots = _split_boots(lavas)
+
+        with metrics.stage('send'):
+            sent = _send_all(lavas, builds, boots, path, direct, throttle)
+
+        for _type, (passed, failed) in sent.items():
+            stats[_type][0].update(passed)
+            stats[_type][1].update(failed)
+
+    # Leftovers only need to be picked up once, along with the first page
+    first_page = True
+    builds_pages = kci.iter_builds(how_many, since.get('build'))
+    lavas_pages = kci.iter_lavas(how_many, since.get('lava'))
+    for builds, lavas in zip_longest(builds_pages, lavas_pages, fillvalue={}):
+        feed_page(builds, lavas, with_leftovers and first_page)
+        first_page = False
+
+    # Nothing new came from KernelCI, still send leftovers
+    if first_page:
+        feed_page({}, {}, with_leftovers)
+
+    return stats
+
+
+def _feed(kci, args, with_leftovers=True, throttle=None):
+    """Run a single feeding cycle, picking KernelCI up from where last cycle stopped"""
+    with metrics.timer('kcing_feed_seconds'):
+        stats = _feed_cycle(kci, args, with_leftovers, throttle)
+
+    metrics.gauge('kcing_last_feed_timestamp_seconds', time.time())
+    return stats
+
+
+def _feed_cycle(kci, args, with_leftovers=True, throttle=None):
+    since = _watermarks(args, kci)
+    if args.stream:
+        stats = _feed_stream(kci, args.how_many, since, direct=args.direct, with_leftovers=with_leftovers, throttle=throttle)
+    else:
+        with metrics.stage('listing'):
+            builds = kci.get_builds(args.how_many, since['build'])
+            lavas = kci.get_lavas(args.how_many, since['lava'])
+
+        with metrics.stage('download'):
+            builds = _download('build', builds, with_leftovers=with_leftovers)
+            lavas = _download('lava', lavas, with_leftovers=with_leftovers)
+        boots = _split_boots(lavas)
+
+        with metrics.stage('send'):
+            stats = _send_all(lavas, builds, boots, direct=args.direct, throttle=throttle)
+
+    _update_watermarks(kci)
+    return stats
+
+
+def _log_stats(stats):
+    saved_lavas, failed_lavas = stats['lava']
+    saved_builds, failed_builds = stats['build']
+    saved_boots, failed_boots = stats['boot']
+    logger.info('Lavas: sent %i to ES, %i failed' % (len(saved_lavas), len(failed_lavas.keys())))
+    logger.info('Builds: sent %i to ES, %i failed' % (len(saved_builds), len(failed_builds.keys())))
+    logger.info('Boots: sent %i to ES, %i failed' % (len(saved_boots), len(failed_boots.keys())))
+
+
 def feed(args):
     """
-    Scan last two days worth of data from KernelCI website/storage
-    and send it to an ES instance, respecting its limitations
+    Scan KernelCI website/storage for data created since the last run (or
+    last two days worth of data) and send it to an ES instance, respecting its limitations
     """
     logger.info('Feeding ES')
 
-    if not _is_es_ok():
+    if args.direct:
+        logger.info('Direct mode is on, lavas/builds/boots are transformed locally and sent straight to ES')
+
+    if not _is_es_ok(args.direct):
         return -1
 
     if not _is_data_dir_ok():
         return -1
 
+    _set_shard(args.shard)
     models.init()
 
     kci = KernelCI()
+    throttle = _backpressure(args.direct)
 
     # If builds or lavas are exclusively passed on command line, ignore the other one
     # otherwise it'd retrieve the regular feed_es data size (past 2 days)
     if args.builds or args.lavas or args.boots:
-        builds = args.builds or {}
-        lavas = args.lavas or {}
-        boots = args.boots or {}
+        logger.info('Using files from command line')
+        stats = _send_all(args.lavas or {}, args.builds or {}, args.boots or {}, direct=args.direct, throttle=throttle)
     else:
-        builds = _download('build', kci.get_builds(args.how_many))
-        lavas = _download('lava', kci.get_lavas(args.how_many))
+        # Delete old objects that are no longer needed
+        with metrics.stage('cleanup'):
+            models.delete_old()
 
-        # During download, some lava files might've been switched to boot files
-        # so let's just separate them and filter them out of lavas dictonary
-        boots = {_id: lavas[_id] for _id in lavas.keys() if 'boot' in lavas[_id]}
-        for _id in boots.keys():
-            del lavas[_id]
+        stats = _feed(kci, args, throttle=throttle)
 
-        # Delete old objects that are no longer needed
-        models.delete_old()
+    models.end()
 
-    logger.info('Working on %i lavas, %i builds and %i boots from KernelCI/command line' % (len(lavas), len(builds), len(boots)))
+    _log_stats(stats)
+    metrics.log_summary()
+    metrics.write()
 
-    saved_lavas, failed_lavas = _send_to_es('lava', lavas)
-    saved_builds, failed_builds = _send_to_es('build', builds)
-    saved_boots, failed_boots = _send_to_es('boot', boots)
 
-    models.end()
+def watch(args):
+    """
+    Keep running, feeding ES every KCING_WATCH_INTERVAL seconds and applying
+    data retention policy every KCING_DRP_INTERVAL seconds. Http sessions, csrf
+    token and kcing.db connection are kept across cycles
+    """
+    logger.info('Watching KernelCI every %i seconds' % (settings.KCING_WATCH_INTERVAL))
+    metrics.serve()
 
-    logger.info('Lavas: sent %i to ES, %i failed' % (len(saved_lavas), len(failed_lavas.keys())))
-    logger.info('Builds: sent %i to ES, %i failed' % (len(saved_builds), len(failed_builds.keys())))
-    logger.info('Boots: sent %i to ES, %i failed' % (len(saved_boots), len(failed_boots.keys())))
+    if not _is_data_dir_ok():
+        return -1
+
+    _set_shard(args.shard)
+    models.init()
+
+    kci = KernelCI()
+    last_drp = 0
+
+    # Only the first cycle needs to scan data dir for leftovers, later
+    # cycles get files that failed to be sent from kcing.db
+    with_leftovers = True
+    try:
+        while True:
+            started = time.time()
+
+            try:
+                if started - last_drp >= settings.KCING_DRP_INTERVAL:
+                    models.drp(args)
+                    drp(args)
+                    last_drp = started
+
+                if _is_es_ok(args.direct):
+                    # Logstash stats get probed again every cycle, in case they were down
+                    _log_stats(_feed(kci, args, with_leftovers, _backpressure(args.direct)))
+                    with_leftovers = False
+            except CannotContinue as e:
+                logger.error('Feeding cycle failed, trying again on next one: %s' % (e))
+                metrics.inc('kcing_feed_failures_total')
+            except Exception:
+                # Files of a cycle cut short might not be recorded anywhere, so next one scans data dir again
+                logger.exception('Feeding cycle crashed, trying again on next one')
+                metrics.inc('kcing_feed_failures_total')
+                with_leftovers = True
+            metrics.write()
+
+            elapsed = time.time() - started
+            logger.info('Cycle took %.2f seconds' % (elapsed))
+            time.sleep(max(0, settings.KCING_WATCH_INTERVAL - elapsed))
+    except KeyboardInterrupt:
+        logger.info('Stopped watching KernelCI')
+
+    models.end()
+    return 0
 
 
 def setup(args):
@@ -287,11 +946,24 @@ def setup(args):
 
     headers = {'Content-Type': 'application/json'}
 
-    # Get mappings files
+    # Templates of boot, build, test and log indices are generated out of a schema,
+    # unless the ones in mapping_templates are asked for. Others (kibana) come from files
+    mappings = {}
     for file_name in listdir('mapping_templates'):
+        mapping_name = file_name.replace('.json', '')
+        if mapping_name in templates.schema and not args.legacy_templates:
+            continue
+
         with open('mapping_templates/%s' % (file_name)) as fh:
-            mapping = fh.read()
+            mappings[file_name] = fh.read()
+
+    if not args.legacy_templates:
+        keyword_fields = templates.kibana_keyword_fields()
+        for mapping_name in templates.schema.keys():
+            template = templates.generate(mapping_name, args.best_compression, keyword_fields)
+            mappings['%s.json' % (mapping_name)] = templates.dumps(template)
 
+    for file_name, mapping in sorted(mappings.items()):
         logger.info('Setting "%s" mapping' % (file_name))
         mapping_name = file_name.replace('.json', '')
         url = '%s/_template/%s' % (es_host, mapping_name)
@@ -310,6 +982,98 @@ def setup(args):
         logger.info('ES answered: %s' % (res.content.decode()))
 
 
+def _sample_docs(samples_dir):
+    """Transform every lava, build and boot file in samples_dir, returns documents by index type"""
+    docs = {index_type: [] for index_type in templates.schema.keys()}
+    for file_name in sorted(listdir(samples_dir)):
+        match = re.match(r'^(lava|build|boot)_.*\.json$', file_name)
+        if not match:
+            continue
+
+        for index, doc in lava.transform_file(match.group(1), join(samples_dir, file_name)) or []:
+            docs[index.split('-')[0]].append(doc)
+
+    return docs
+
+
+def _index_size(index, template, docs):
+    """
+    Index docs into a scratch index created out of template, returns its size
+    in bytes after merging it down to a single segment, or None on errors
+    """
+    headers = {'Content-Type': 'application/json'}
+    url = '%s/%s' % (es_host, index)
+    body = {
+        'settings': dict(template['settings'], number_of_replicas=0),
+        'mappings': template['mappings'],
+    }
+
+    try:
+        res = _client().put(url, headers=headers, data=json.dumps(body))
+        if res.status_code != 200:
+            logger.error('Failed to create %s: %s' % (index, res.content.decode()))
+            return None
+
+        errors = bulk([({'_index': index}, doc) for doc in docs])
+        if errors is None:
+            return None
+
+        if len(errors):
+            logger.warning('%i documents were not indexed into %s, first error: %s' % (len(errors), index, errors[0]['error']))
+
+        _client().post('%s/_refresh' % (url))
+        _client().post('%s/_forcemerge?max_num_segments=1' % (url))
+        res = _client().get('%s/_stats/store' % (url))
+        return json.loads(res.content.decode())['_all']['primaries']['store']['size_in_bytes']
+    except:
+        logger.error('Failed to measure %s size due to connection issues' % (index))
+        return None
+    finally:
+        try:
+            _client().delete(url)
+        except:
+            logger.error('Failed to delete %s' % (index))
+
+
+def size_report(args):
+    """
+    Compare how big boot, build, test and log indices get with templates in
+    mapping_templates and with generated ones, indexing files in --samples-dir
+    """
+    logger.info('Measuring index sizes of samples in %s' % (args.samples_dir))
+
+    if not _is_es_ok(direct=True):
+        return -1
+
+    docs = _sample_docs(args.samples_dir)
+    keyword_fields = templates.kibana_keyword_fields()
+
+    total = {'legacy': 0, 'generated': 0}
+    for index_type in sorted(templates.schema.keys()):
+        if len(docs[index_type]) == 0:
+            logger.info('%s: no samples' % (index_type))
+            continue
+
+        with open('mapping_templates/%s.json' % (index_type)) as fh:
+            legacy = json.load(fh)
+        generated = templates.generate(index_type, args.best_compression, keyword_fields)
+
+        legacy_size = _index_size('kcing-size-legacy-%s' % (index_type), legacy, docs[index_type])
+        generated_size = _index_size('kcing-size-generated-%s' % (index_type), generated, docs[index_type])
+        if legacy_size is None or generated_size is None:
+            return -1
+
+        total['legacy'] += legacy_size
+        total['generated'] += generated_size
+        logger.info('%s: %i docs, %i bytes with mapping_templates, %i bytes generated (%.1f%% smaller)' % (
+                    index_type, len(docs[index_type]), legacy_size, generated_size, 100 - 100.0 * generated_size / legacy_size))
+
+    if total['legacy']:
+        logger.info('Total: %i bytes with mapping_templates, %i bytes generated (%.1f%% smaller)' % (
+                    total['legacy'], total['generated'], 100 - 100.0 * total['generated'] / total['legacy']))
+    return 0
+
+
 def drp(args):
     logger.info('Data Rentention Ploicy will clean up indices older than %i days in ElasticSearch' % (args.drp_days))
 
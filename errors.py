@@ -0,0 +1,9 @@
+#!/usr/bin/env python3
+
+# Exceptions shared by kcing modules, kept apart so that raising or catching
+# them doesn't drag in the module that happens to raise them most
+
+
+class CannotContinue(Exception):
+    """We can't really do anything for now"""
+    pass
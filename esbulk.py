@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# ES _bulk api, shared by the feeder (elastic.py, when skipping logstash) and
+# kibana.py restoring saved objects
+
+import json
+import logging
+
+import metrics
+import settings
+import transport
+
+logger = logging.getLogger()
+
+es_host = settings.ES_HOST
+
+
+def bulk(docs, chunk_size=None):
+    """
+    Index (action, document) pairs through ES _bulk api, where action holds at least
+    `_index`. Returns the list of items ES failed to index or None if a request failed
+    """
+    chunk_size = chunk_size or settings.ES_BULK_SIZE
+    url = '%s/_bulk' % (es_host)
+    headers = {'Content-Type': 'application/x-ndjson'}
+
+    # Indexing documents with an id twice just overwrites them, so failed requests can be sent again
+    idempotent = all('_id' in action for action, doc in docs)
+
+    errors = []
+    for i in range(0, len(docs), chunk_size):
+        lines = []
+        for action, doc in docs[i:i + chunk_size]:
+            lines.append(json.dumps({'index': action}))
+            lines.append(json.dumps(doc))
+        content = '\n'.join(lines) + '\n'
+
+        try:
+            logger.debug('Bulk indexing %i documents (%i bytes)' % (len(lines) // 2, len(content)))
+            with metrics.timer('kcing_bulk_seconds'):
+                response = transport.client().post(url, data=content.encode(), headers=headers, retries=settings.ES_MAX_RETRIES - 1, idempotent=idempotent)
+        except:
+            logger.error('Failed to bulk index documents due to connection issues')
+            metrics.inc('kcing_bulk_requests_total', result='failed')
+            return None
+
+        if response.status_code != 200:
+            logger.error('Failed to bulk index documents, ES returned %i' % (response.status_code))
+            logger.error(response.content.decode())
+            metrics.inc('kcing_bulk_requests_total', result='failed')
+            return None
+
+        metrics.inc('kcing_bulk_requests_total', result='ok')
+        metrics.inc('kcing_bulk_docs_total', len(lines) // 2)
+
+        result = json.loads(response.content.decode())
+        if result['errors']:
+            for item in result['items']:
+                item = item['index']
+                if 'error' in item:
+                    errors.append(item)
+
+    return errors
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import cProfile
 import logging
+import pstats
 import sys
+import time
 
 import elastic
 import logstash
@@ -31,7 +34,9 @@ def drp(args):
 avail_cmds = {
     'test': tests.run,
     'feed_es': elastic.feed,
+    'watch': elastic.watch,
     'setup_es': elastic.setup,
+    'size_report': elastic.size_report,
     'setup_ls': logstash.setup,
     'setup_kbn': kibana.setup,
     'backup_kbn': kibana.backup,
@@ -54,7 +59,39 @@ def main(args):
 
     # Call
     func = avail_cmds[args.cmd]
-    return func(args)
+    if not args.profile:
+        return func(args)
+
+    return profile(func, args)
+
+
+def profile(func, args):
+    """Run func under cProfile, saving stats to --profile-out file (or kcing-<cmd>-<timestamp>.pstats)"""
+    file_name = args.profile_out or 'kcing-%s-%s.pstats' % (args.cmd, time.strftime('%Y%m%d-%H%M%S'))
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, args)
+    finally:
+        profiler.dump_stats(file_name)
+        logger.info('Profiling stats saved to %s, e.g. `python -m pstats %s`' % (file_name, file_name))
+
+        if args.debug:
+            stats = pstats.Stats(profiler)
+            stats.sort_stats('cumulative').print_stats(20)
+
+
+def shard(value):
+    """Parse --shard i/N into (i, N)"""
+    try:
+        index, count = [int(n) for n in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, e.g. 0/4, got "%s"' % (value))
+
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError('shard index should be between 0 and %i, got "%s"' % (count - 1, value))
+
+    return index, count
 
 
 if __name__ == '__main__':
@@ -64,17 +101,31 @@ if __name__ == '__main__':
                              "`gen_samples` generates --sample-size (or past two days of) lavas and builds from kernelci and save it to --samples-dir. "
                              "`setup_ls` configures logstash to better use queueing. "
                              "`setup_es` send mapping templates to ES. "
+                             "`size_report` compares index sizes of --samples-dir files with legacy and generated mapping templates. "
                              "`setup_kbn` restore kibana saved objects. "
                              "`backup_kbn` dump kibana saved objects to `kcing.kibana`. "
                              "`feed_es` downloads lavas/builds from kernelci and submit them to ES. "
+                             "`watch` keeps running `feed_es` every KCING_WATCH_INTERVAL seconds and `drp` every KCING_DRP_INTERVAL seconds. "
                              "`drp` apply Data Rentention Policy"
     )
     parser.add_argument("-l", "--log-filename",
                         help="Logging file name")
     parser.add_argument("-d", "--debug", action='store_true',
                         help="Debugging log level")
+    parser.add_argument("--profile", action='store_true',
+                        help="Run the command under cProfile and save stats to --profile-out")
+    parser.add_argument("--profile-out", metavar='PSTATS_FILE',
+                        help="Where --profile saves stats, defaults to kcing-<cmd>-<timestamp>.pstats")
     parser.add_argument("--how-many", type=int, default=-1,
                         help="How many lavas and builds to feed ES, defaults to two past days worth of data")
+    parser.add_argument("--stream", action='store_true',
+                        help="Download and send lavas and builds as soon as each KernelCI listing page is retrieved")
+    parser.add_argument("--direct", action='store_true',
+                        help="Transform lavas/builds/boots locally and send them straight to ES _bulk api, skipping Logstash")
+    parser.add_argument("--full-scan", action='store_true',
+                        help="Ignore sync watermarks and list the past two days of lavas and builds from KernelCI")
+    parser.add_argument("--shard", type=shard, metavar='i/N',
+                        help="When running `feed_es` or `watch`, only download and send kernelci objects whose oid crc32 modulo N is i, so that N workers can split the work")
     parser.add_argument("--builds", nargs='+',
                         help="List of build files to send to ES")
     parser.add_argument("--lavas", nargs='+',
@@ -85,6 +136,12 @@ if __name__ == '__main__':
                         help="How many samples to download, defaults to two past days worth of data")
     parser.add_argument("--samples-dir", default='samples',
                         help="Directory to where samples are going to be stored, defaults to `samples`")
+    parser.add_argument("--best-compression", action='store_true',
+                        help="When running `setup_es` or `size_report`, generate templates using best_compression codec")
+    parser.add_argument("--legacy-templates", action='store_true',
+                        help="When running `setup_es`, send boot/build/test/log templates in mapping_templates instead of generating them")
+    parser.add_argument("--skip-unchanged", action='store_true',
+                        help="When running `setup_kbn`, only restore saved objects that differ from the ones in kibana")
     parser.add_argument("--drp-days", type=int, default=settings.DRP_DAYS,
                         help="Apply data retention policy to delete objects older than '--drp-days' days")
     parser.add_argument("-t", "--testargs", nargs='*',
@@ -12,27 +12,40 @@ import json
 import logging
 import os
 import re
-import requests
-import time
 import sys
+import threading
+
+from datetime import datetime
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 
+import requests
+
 #import models
+import metrics
 import settings
+import transport
+from errors import CannotContinue
 
 logger = logging.getLogger()
 
-class CannotContinue(Exception):
-    """We can't really do anything for now"""
-    pass
+
+def _created_on(doc):
+    """KernelCI dates come as {"$date": <milliseconds since epoch>}"""
+    return datetime.utcfromtimestamp(doc['created_on']['$date'] / 1000)
+
 
 class KernelCI(object):
 
-    def __init__(self, max_retries=5, max_per_req=1000):
-        # Browser-like client
-        self.client = requests.session()
-        self.client.headers['Connection'] = 'keep-alive'
+    def __init__(self, max_retries=5, max_per_req=1000, max_workers=None):
+        # Max number of listing pages to retrieve at the same time
+        self.max_workers = max_workers or settings.KCI_LISTING_WORKERS
+
+        # Browser-like client, shared with everything else. Csrf token is only sent to KernelCI
+        self.client = transport.client()
+        self.headers = {}
 
         self.lavas = []
         self.builds = []
@@ -40,13 +53,15 @@ class KernelCI(object):
         # Urls
         self.url_scheme = settings.KCI_SCHEME + '://'
         self.url = settings.KCI_HOST
-        self.storage_url = self.url_scheme + 'storage.%s' % (self.url)
+        self.storage_url = settings.KCI_STORAGE_URL
         self.url = self.url_scheme + self.url
+        transport.mount(self.url, self.max_workers)
         self.boot_url = os.path.join(self.url, '_ajax', 'boot')
         self.build_url = os.path.join(self.url, '_ajax', 'build')
 
         # Csrf regex (extract from meta tag)
         self.csrf_regex = re.compile('csrf-token.*?content="([^"]+)"', re.S)
+        self.csrf_lock = threading.Lock()
 
         # Max client retries before giving up
         self.max_retries = max_retries
@@ -54,6 +69,15 @@ class KernelCI(object):
         # Max number of objects to retrieve per request to kernelci
         self.max_objs_per_request = max_per_req
 
+        # Only fields needed to build storage links are requested, keeping listings small
+        self.doc_fields = {
+            'lava': ['_id', 'created_on', 'file_server_resource', 'lab_name', 'board'],
+            'build': ['_id', 'created_on', 'file_server_resource'],
+        }
+
+        # Most recent (created_on, oid) retrieved of each doc type, used as sync watermark
+        self.newest = {}
+
     def _http(self, url, method='get', blocking=True):
         if method not in ['get', 'head']:
             logger.error('Http method "%s" is unknown' % (method))
@@ -63,38 +87,65 @@ class KernelCI(object):
 
             return
 
-        attempts = 0
-        wait_for = 2
         client_method = getattr(self.client, method)
         method = method.upper()
-        while attempts < self.max_retries:
-            try:
-                logger.debug('%s "%s"' % (method, url))
-                response = client_method(url)
-                return response
-            except:
-                logger.warning('Failed to %s "%s", trying again in %i seconds' % (method, url, wait_for))
-                time.sleep(wait_for)
-                attempts += 1
-                wait_for *= 2
+        try:
+            logger.debug('%s "%s"' % (method, url))
+            return client_method(url, headers=self.headers, retries=self.max_retries - 1)
+        except requests.RequestException as e:
+            logger.error('Failed to %s "%s": %s' % (method, url, e))
 
         if blocking:
             raise CannotContinue('Exceeded attempts to %s "%s"' % (method, url))
 
     def _refresh_csrf_token(self):
-        response = self._http(self.url) 
-        html = response.content.decode()
-        matches = self.csrf_regex.search(html)
-        if matches:
-            token = matches.groups(1)[0]
-            self.client.headers['x-csrftoken'] = token 
-            logger.info('New csrf "%s"' % (token))
-            return token
-        else:
-            raise CannotContinue('Failed to retrieve new csrf token')
+        # Listing windows run concurrently, let only one of them refresh the token at a time
+        with self.csrf_lock:
+            metrics.inc('kcing_csrf_refreshes_total')
+            response = self._http(self.url)
+            html = response.content.decode()
+            matches = self.csrf_regex.search(html)
+            if matches:
+                token = matches.groups(1)[0]
+                self.headers['x-csrftoken'] = token
+                logger.info('New csrf "%s"' % (token))
+                return token
+            else:
+                raise CannotContinue('Failed to retrieve new csrf token')
 
-    def _get_docs(self, _type, date_range=2, how_many=-1):
-        docs = []
+    def _get_page(self, url, params, skip):
+        """Retrieve a single listing window starting at `skip`, returns None if it keeps failing"""
+        query = urlencode(dict(params, skip=skip), doseq=True)
+        attempts = 0
+        endpoint = os.path.basename(url)
+        while attempts <= self.max_retries:
+            with metrics.timer('kcing_listing_page_seconds', endpoint=endpoint):
+                response = self._http(url + '?' + query)
+            if response.status_code == 200:
+                result = json.loads(response.content.decode())
+                return result['result']
+
+            attempts += 1
+            logger.debug('Failed to retrieve "%s", attempt (%i) to refresh csrf' % (url, attempts))
+            self._refresh_csrf_token()
+
+        logger.error('Exceeded attempts to retrieve "%s"' % (url + '?' + query))
+        return None
+
+    def _newest_first(self, how_many=-1, since=None):
+        """Listing since a watermark goes newest first, unless it's limited to `how_many` docs"""
+        return since is not None and how_many <= 0
+
+    def _iter_docs(self, _type, date_range=2, how_many=-1, since=None):
+        """
+        Yield retrieved docs page by page, sorted by created_on. If `since` is given,
+        docs are retrieved newest first and listing stops as soon as it gets to `since`.
+        In that case the sync watermark (self.newest) only moves once listing actually
+        got to `since`, otherwise docs left in between would never be listed again.
+        Limited to `how_many` docs, listing goes oldest first from `since` instead, so
+        that each run picks up where the last one stopped. Docs up to the watermark
+        are listed again, but don't count
+        """
         url = None
         limit = self.max_objs_per_request
 
@@ -107,74 +158,154 @@ class KernelCI(object):
             logger.error('Unknown doc_type "%s"' % (_type))
             return
 
-        if how_many > 0 and how_many < limit:
+        # Docs left from the overlap with the watermark are not known ahead of time
+        if how_many > 0 and how_many < limit and since is None:
             limit = how_many
-        
+
+        newest_first = self._newest_first(how_many, since)
+        sort_order = -1 if newest_first else 1
+        if since is not None:
+            date_range = (datetime.utcnow() - since).days + 1
+            logger.info('Retrieving %ss created since %s' % (_type, since))
+
         params = {
             'date_range': date_range,
-            'skip': 0,
             'limit': limit,
             'sort': 'created_on',
-            'sort_order': 1,
+            'sort_order': sort_order,
+            'field': self.doc_fields[_type],
         }
 
-        count = 1
-        attempts = 0
-        self._refresh_csrf_token()
-        while count > 0 and attempts <= self.max_retries:
-            query = urlencode(params)
-            response = self._http(url + '?' + query)
-            if response.status_code != 200:
-                attempts += 1
-                logger.debug('Failed to retrieve %s, attempt (%i) to refresh csrf' % (doc_type, attempts))
-                self._refresh_csrf_token()
-                continue
-
-            result = json.loads(response.content.decode())
-            objects = result['result']
+        # Windows are known ahead of time (skip = N * limit), so keep up to `max_workers`
+        # of them in flight and consume them in order, thus keeping docs sorted by created_on.
+        # Windows keep being retrieved while the caller works on the page just yielded.
+        # When listing since a watermark, most likely a single window is enough, so only
+        # go concurrent after the first window comes back full
+        window = 1 if since is not None else self.max_workers
+
+        # Token is kept across listings, _get_page refreshes it when it expires
+        if 'x-csrftoken' not in self.headers:
+            self._refresh_csrf_token()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = deque()
+            skip = 0
+            retrieved = 0
+            newest = self.newest.get(_type)
+            watermark = newest if since is not None else None
+            complete = False
+            while True:
+                while len(in_flight) < window and (how_many <= 0 or since is not None or skip < how_many):
+                    in_flight.append(executor.submit(self._get_page, url, params, skip))
+                    skip += limit
+
+                if len(in_flight) == 0:
+                    break
+
+                objects = in_flight.popleft().result()
+                if objects is None:
+                    break
+
+                count = len(objects)
+                logger.debug('Retrieved %i docs' % (count))
+                metrics.inc('kcing_listed_docs_total', count, type=_type)
+                window = self.max_workers
+
+                reached_since = False
+                if since is not None:
+                    newer = [o for o in objects if _created_on(o) >= since]
+                    reached_since = newest_first and len(newer) < count
+                    objects = newer
+
+                if how_many > 0:
+                    kept = []
+                    for o in objects:
+                        if retrieved >= how_many:
+                            break
+                        kept.append(o)
+                        if watermark is None or (_created_on(o), o['_id']['$oid']) > watermark:
+                            retrieved += 1
+                    objects = kept
+
+                for o in objects:
+                    created = (_created_on(o), o['_id']['$oid'])
+                    if newest is None or created > newest:
+                        newest = created
+
+                # Listing oldest first, everything before the newest doc retrieved so far is already listed
+                if not newest_first and newest is not None:
+                    self.newest[_type] = newest
+
+                if len(objects):
+                    yield objects
+
+                # A short page means there's nothing left to retrieve
+                if count < limit or reached_since:
+                    complete = True
+                    break
+
+                if how_many > 0 and retrieved >= how_many:
+                    break
+
+            # Speculative windows past the end are no longer needed
+            executor.shutdown(cancel_futures=True)
+
+        if newest_first:
+            if complete and newest is not None:
+                self.newest[_type] = newest
+            elif not complete:
+                logger.warning('Listing %ss did not get back to %s, their sync watermark stays where it was' % (_type, since))
+
+    def _get_docs(self, _type, date_range=2, how_many=-1, since=None):
+        docs = []
+        for objects in self._iter_docs(_type, date_range=date_range, how_many=how_many, since=since):
+            docs += objects
 
-            count = len(objects)
-            logger.debug('Retrieved %i docs' % (count))
-            if count:
-                docs += objects
+        if self._newest_first(how_many, since):
+            docs.reverse()
 
-            if how_many > 0 and len(docs) >= how_many:
-                break
+        return docs
 
-            # Skip `count` objects on next request
-            params['skip'] += count
+    def _doc_to_link(self, _type, d):
+        """Get storage link of a retrieved doc_type"""
+        path = d['file_server_resource']
 
-            # Reset attempts
-            attempts = 0
+        filename = ''
+        if _type == 'lava':
+            lab = d['lab_name']
+            filename = os.path.join(lab, 'lava-json-%s.json' % (d['board']))
+        elif _type == 'build':
+            filename = 'build.json'
+        else:
+            raise CannotContinue('Unexpected doc_type "%s"' % (_type))
 
-        return docs
+        return os.path.join(self.storage_url, path, filename)
 
-    def _docs_to_links(self, _type, how_many=-1):
+    def _docs_to_links(self, _type, how_many=-1, since=None):
         """Get a list of retrieved doc_types, links are ready to download from storage"""
         logger.info('Retrieving %ss from KernelCI' % (_type))
-        docs = self._get_docs(_type, how_many=how_many)
+        docs = self._get_docs(_type, how_many=how_many, since=since)
         ready_to_download = {}
 
         for d in docs:
-            _id = d['_id']['$oid']
-            path = d['file_server_resource']
-
-            filename = ''
-            if _type == 'lava':
-                lab = d['lab_name']
-                filename = os.path.join(lab, 'lava-json-%s.json' % (d['board']))
-            elif _type == 'build':
-                filename = 'build.json'
-            else:
-                raise CannotContinue('Unexpected doc_type "%s"' % (_type))
-
-            ready_to_download[_id] = os.path.join(self.storage_url, path, filename)
+            ready_to_download[d['_id']['$oid']] = self._doc_to_link(_type, d)
 
         logger.info('Got %i' % (len(ready_to_download)))
         return ready_to_download
 
-    def get_lavas(self, how_many=-1):
-        return self._docs_to_links('lava', how_many=how_many)
+    def _iter_links(self, _type, how_many=-1, since=None):
+        """Same as _docs_to_links, but yield links page by page as soon as they're retrieved"""
+        logger.info('Streaming %ss from KernelCI' % (_type))
+        for docs in self._iter_docs(_type, how_many=how_many, since=since):
+            yield {d['_id']['$oid']: self._doc_to_link(_type, d) for d in docs}
+
+    def get_lavas(self, how_many=-1, since=None):
+        return self._docs_to_links('lava', how_many=how_many, since=since)
+
+    def get_builds(self, how_many=-1, since=None):
+        return self._docs_to_links('build', how_many=how_many, since=since)
+
+    def iter_lavas(self, how_many=-1, since=None):
+        return self._iter_links('lava', how_many=how_many, since=since)
 
-    def get_builds(self, how_many=-1):
-        return self._docs_to_links('build', how_many=how_many)
+    def iter_builds(self, how_many=-1, since=None):
+        return self._iter_links('build', how_many=how_many, since=since)
@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 
 import logging
-import requests
 import json
+import os
 
 
+import esbulk
+from errors import CannotContinue
 import settings
+import transport
 
 
 logger = logging.getLogger()
 
 kibana_filename = 'kcing.kibana'
 kibana_mapping = 'mapping_templates/kibana.json'
+kibana_alias = '.kibana'
+kibana_index = '.kibana_1'
+page_size = 1000
 es_host = settings.ES_HOST
 kb_url = settings.KB_URL
 kb_hidden_url = '<kibana-url>'
@@ -26,49 +32,146 @@ def _replace_kibana_url(content):
     return content.replace(kb_hidden_url, kb_url)
 
 
+def _kibana_index():
+    """Get the index kibana's alias points to, falling back to kibana_index"""
+    url = '%s/_alias/%s' % (es_host, kibana_alias)
+    try:
+        res = transport.client().get(url, headers=headers)
+    except:
+        logger.warning('Failed to resolve %s alias due to connection issues, using %s' % (kibana_alias, kibana_index))
+        return kibana_index
+
+    if res.status_code != 200:
+        logger.warning('Failed to resolve %s alias due to http return code %i, using %s' % (kibana_alias, res.status_code, kibana_index))
+        return kibana_index
+
+    indices = sorted(json.loads(res.content.decode()).keys())
+    if len(indices) != 1:
+        logger.warning('%s alias points to %s, using %s' % (kibana_alias, indices, kibana_index))
+        return kibana_index
+
+    return indices[0]
+
+
+def _iter_objects(index):
+    """
+    Yield all saved objects in index, a page at a time. Raises CannotContinue if paging fails.
+    Sorting on _id needs fielddata, which is deprecated, so objects are sorted by type and then
+    by _seq_no, unique within kibana's single shard index. Objects restored by setup_kbn keep
+    the order they have in kcing.kibana, the ones edited since go last among their type
+    """
+    url = '%s/%s/_search' % (es_host, index)
+    search = {
+        'size': page_size,
+        'query': {'match_all': {}},
+        'sort': [{'type': 'asc'}, {'_seq_no': 'asc'}],
+        'track_scores': True,
+    }
+
+    while True:
+        try:
+            res = transport.client().post(url, headers=headers, data=json.dumps(search))
+        except:
+            raise CannotContinue('Failed to backup kibana data due to connection issues')
+
+        if res.status_code != 200:
+            logger.error('%s' % (res.content.decode()))
+            raise CannotContinue('Failed to backup kibana data due to http return code %i' % (res.status_code))
+
+        hits = json.loads(res.content.decode())['hits']['hits']
+        for hit in hits:
+            search['search_after'] = hit.pop('sort')
+            yield hit
+
+        if len(hits) < page_size:
+            break
+
+
+def _backup_objects(index, file_name):
+    """
+    Write saved objects to file_name as they're retrieved, in the same format json.dump(..., indent=2)
+    would, so diffs stay small. A temporary file is used, so a failed backup leaves file_name alone
+    """
+    temp_name = '%s.tmp' % (file_name)
+    count = 0
+    try:
+        with open(temp_name, 'w') as fh:
+            fh.write('[')
+            for hit in _iter_objects(index):
+                content = _hide_kibana_url(json.dumps(hit, sort_keys=True, indent=2))
+                fh.write(',\n' if count else '\n')
+                fh.write('\n'.join('  ' + line for line in content.split('\n')))
+                count += 1
+            fh.write('\n]' if count else ']')
+
+        os.replace(temp_name, file_name)
+    except CannotContinue as e:
+        logger.error(e)
+        return -1
+    finally:
+        if os.path.exists(temp_name):
+            os.unlink(temp_name)
+
+    return count
+
+
 def backup(args):
     logger.info('Backing up kibana data & mapping')
 
-    mapping_url = '%s/.kibana_1/_mapping' % (es_host)
-    data_url = '%s/.kibana_1/_search' % (es_host)
-    search = """{
-       "size": 10000,
-        "query": {
-            "match_all": {}
-        }
-    }"""
-
+    index = _kibana_index()
+    mapping_url = '%s/%s/_mapping' % (es_host, index)
     try:
-        data_res = requests.post(data_url, headers=headers, data=search)
-        mapping_res = requests.get(mapping_url, headers=headers)
+        mapping_res = transport.client().get(mapping_url, headers=headers)
     except:
         logger.error('Failed to backup kibana due to connection issues')
-        return
-
-    if data_res.status_code != 200:
-        logger.error('Failed to backup kibana data due to http return code %i' % (data_res.status_code))
-        logger.error('%s' % (data_res.content.decode()))
-        return
+        return -1
 
     if mapping_res.status_code != 200:
         logger.error('Failed to backup kibana mappings due to http return code %i' % (mapping_res.status_code))
         logger.error('%s' % (mapping_res.content.decode()))
-        return
+        return -1
 
     # Save data to kcing.kibana
-    objects_str = _hide_kibana_url(data_res.content.decode())
-    objects = json.loads(objects_str)['hits']['hits']
-    with open(kibana_filename, 'w') as fh:
-        json.dump(objects, fh, sort_keys = True, indent = 2)
-    logger.info('Kibana objects saved to %s' % (kibana_filename))
+    count = _backup_objects(index, kibana_filename)
+    if count < 0:
+        return -1
+    logger.info('%i kibana objects saved to %s' % (count, kibana_filename))
 
     # Save mapings to mapping_templates/kibana.json
-    mapping = json.loads(mapping_res.content.decode())['.kibana_1']
-    mapping['index_patterns'] = ['.kibana_1']
+    mapping = json.loads(mapping_res.content.decode())[index]
+    mapping['index_patterns'] = [index]
     mapping['settings'] = {'number_of_shards': 1}
     with open(kibana_mapping, 'w') as fh:
         json.dump(mapping, fh, sort_keys = True, indent = 2)
     logger.info('Kibana mappings saved to %s' % (kibana_mapping))
+    return 0
+
+
+def _current_objects(index, ids):
+    """Get saved objects currently in kibana index, by id. Returns None if they can't be retrieved"""
+    url = '%s/%s/_mget' % (es_host, index)
+    current = {}
+    for i in range(0, len(ids), settings.ES_BULK_SIZE):
+        try:
+            res = transport.client().post(url, headers=headers, data=json.dumps({'ids': ids[i:i + settings.ES_BULK_SIZE]}))
+        except:
+            logger.error('Failed to retrieve current kibana objects due to connection issues')
+            return None
+
+        # No kibana index yet, so there's nothing to compare to
+        if res.status_code == 404:
+            return {}
+
+        if res.status_code != 200:
+            logger.error('Failed to retrieve current kibana objects due to http return code %i' % (res.status_code))
+            logger.error(res.content.decode())
+            return None
+
+        for doc in json.loads(res.content.decode())['docs']:
+            if doc.get('found'):
+                current[doc['_id']] = doc['_source']
+
+    return current
 
 
 def setup(args):
@@ -81,27 +184,30 @@ def setup(args):
 
     if objects == None or len(objects) == 0:
         logger.error('Failed to read %s or it is empty' % (kibana_filename))
-        return
-
-    sent = 0
-    failed = 0
-    for o in objects:
-        try:
-            url = '%s/.kibana_1/_doc/%s' % (es_host, o['_id'])
-            data = json.dumps(o['_source'])
-            res = requests.put(url, headers=headers, data=data)
-        except:
-            logger.error('Failed to restore %s in kibana index' % (o['_id']))
-            failed = failed + 1
-            continue
-
-        if res.status_code != 200 and res.status_code != 201:
-            logger.error('Failed to restore %s due to kibanas http return %i' % (o['_id'], res.status_code))
-            logger.error(res.content.decode())
-            failed = failed + 1
-            continue
-
-        logger.info('%s: %s' % (o['_id'], res.content.decode()))
-        sent = sent + 1
-
-    logger.info('Sent %i saved objects to kibana, and %i failed' % (sent, failed))
+        return -1
+
+    index = _kibana_index()
+    if args.skip_unchanged:
+        current = _current_objects(index, [o['_id'] for o in objects])
+        if current is None:
+            logger.warning('Could not compare to current kibana objects, restoring all of them')
+        else:
+            changed = [o for o in objects if current.get(o['_id']) != o['_source']]
+            logger.info('Skipping %i saved objects that are unchanged in kibana' % (len(objects) - len(changed)))
+            objects = changed
+
+    if len(objects) == 0:
+        logger.info('Kibana saved objects are up to date')
+        return 0
+
+    # Restore everything through _bulk api, instead of a request per object
+    errors = esbulk.bulk([({'_index': index, '_id': o['_id']}, o['_source']) for o in objects])
+    if errors is None:
+        logger.error('Failed to restore kibana saved objects')
+        return -1
+
+    for error in errors:
+        logger.error('Failed to restore %s: %s' % (error['_id'], error['error']))
+
+    logger.info('Sent %i saved objects to kibana, and %i failed' % (len(objects) - len(errors), len(errors)))
+    return 0 if len(errors) == 0 else -1
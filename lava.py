@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# Turns lava, build and boot files into the very same documents
+# kcing_pipeline.conf would index, so they can be sent straight to ES
+
+import json
+import logging
+from datetime import datetime
+
+import yaml
+
+import settings
+
+logger = logging.getLogger()
+
+# Parsing yaml is by far the most expensive step, use libyaml when available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Lava fields that don't make it to boot, test and log documents
+removed_fields = ['id', 'description', 'version', 'status_string', 'definition',
+                  'start_time', 'boot_log_html', 'failure_comment',
+                  'metadata', 'actual_device_id', '@version', 'submit_time',
+                  'end_time', 'status', 'submitter_username', 'host']
+
+# Common fields extracted from lava job definition's metadata
+definition_fields = {
+    'git_commit': 'git.commit',
+    'git_branch': 'git.branch',
+    'git_describe': 'git.describe',
+    'job': 'kernel.tree',
+    'kernel': 'kernel.version',
+    'defconfig_full': 'kernel.defconfig',
+    'build_environment': 'job.build_environment',
+    'board': 'device.type',
+    'arch': 'job.arch',
+    'file_server_resource': 'job.file_server_resource',
+    'mach': 'platform.mach',
+    'endian': 'kernel.endian',
+    'platform_name': 'platform.name',
+}
+
+# Fields each test result becomes in test documents
+test_fields = ['result', 'unit', 'name', 'measurement', 'log_start_line',
+               'log_end_line', 'suite', 'level', 'logged', 'id']
+
+# Fields each log line becomes in log documents
+log_fields = ['lvl', 'dt', 'msg', 'lineno']
+
+# Fields each chunk of KCING_LOG_CHUNK log lines becomes in log documents
+log_chunk_fields = ['lvl', 'dt', 'msg', 'lineno', 'lineno_start', 'lineno_end']
+
+
+class InvalidDocument(Exception):
+    """Document can't be transformed, logstash would've tagged it as an error"""
+    pass
+
+
+def _load_yaml(content):
+    return yaml.load(content, Loader=YamlLoader)
+
+
+def _as_text(value):
+    """Logstash's add_field turns values into strings, stick to it"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _timestamp(now):
+    return now.strftime('%Y-%m-%dT%H:%M:%S.') + '%03iZ' % (now.microsecond // 1000)
+
+
+def _index(index_type, now):
+    return '%s-%s' % (index_type, now.strftime('%Y.%m.%d'))
+
+
+def _tests(results, timestamp):
+    """Parse yaml test results, returns the list of tests along with boot result and time"""
+    boot_result = ''
+    boot_time = ''
+    tests = []
+    for suite, values in results.items():
+        for _set in _load_yaml(values) or []:
+
+            # Remove unwanted data (metadata keeps changing and it messes up with ES)
+            for field in ['metadata', 'job', 'url']:
+                _set.pop(field, None)
+
+            # Truncate datatime precision, lab-bjorn results don't have 'logged' field
+            if _set.get('logged') is not None:
+                _set['logged'] = str(_set['logged'])[:-9]
+            else:
+                _set['logged'] = timestamp
+
+            # Fill in gaps for lab-bjorn
+            defaults = {'suite': 'lava', 'measurement': 0, 'unit': '', 'level': '', 'id': ''}
+            for field, default in defaults.items():
+                if _set.get(field) is None:
+                    _set[field] = default
+
+            if _set.get('log_start_line') is None:
+                _set['log_start_line'] = 0
+                _set['log_end_line'] = 0
+
+            # Get boot info
+            if _set.get('name') == 'auto-login-action':
+                boot_result = _set.get('result')
+                boot_time = _set.get('measurement')
+
+            tests.append(_set)
+
+    # lab-bjorn might not run auto-login-action, so we just add boot
+    if boot_result == '':
+        boot_result = 'pass'
+        boot_time = 0
+
+    return tests, boot_result, boot_time
+
+
+def _logs(log):
+    """Parse yaml log, truncating second precision to 3 digits, instead of 6 and adding line number"""
+    logs = []
+    for lineno, _log in enumerate(_load_yaml(log) or [], start=1):
+        _log['dt'] = str(_log['dt'])[:-3]
+        _log['lineno'] = lineno
+        logs.append(_log)
+    return logs
+
+
+def _log_chunks(logs, size):
+    """
+    Group consecutive log lines, so that a single document holds `size` of them instead of
+    each line getting its own copy of every common field. Levels of the lines are kept as
+    a list and `lineno` is the first line, so that sorting by it still works
+    """
+    chunks = []
+    for i in range(0, len(logs), size):
+        lines = logs[i:i + size]
+        levels = []
+        for _log in lines:
+            if _log.get('lvl') not in levels:
+                levels.append(_log.get('lvl'))
+
+        chunks.append({
+            'dt': lines[0]['dt'],
+            'lvl': levels,
+            'msg': '\n'.join(_as_text(_log.get('msg')) for _log in lines),
+            'lineno': lines[0]['lineno'],
+            'lineno_start': lines[0]['lineno'],
+            'lineno_end': lines[-1]['lineno'],
+        })
+    return chunks
+
+
+def _lava_docs(lava, now):
+    """Span boot, test and log documents out of a lava document"""
+    for field in ['results', 'definition', 'log', 'id']:
+        if lava.get(field) in [None, '']:
+            raise InvalidDocument('Lava document is missing "%s"' % (field))
+
+    timestamp = _timestamp(now)
+    tests, boot_result, boot_time = _tests(lava['results'], timestamp)
+    logs = _logs(lava['log'])
+
+    # Extract common fields to later span boot, test and log documents
+    metadata = _load_yaml(lava['definition'])['metadata']
+    common = {field: value for field, value in lava.items() if field not in removed_fields + ['results', 'log']}
+    for field, key in definition_fields.items():
+        common[field] = metadata.get(key)
+    common['boot_result'] = _as_text(boot_result).lower()
+    common['boot_time'] = boot_time
+    common['@timestamp'] = timestamp
+    job_id = _as_text(lava['id'])
+
+    docs = [(_index('boot', now), common)]
+
+    for test in tests:
+        doc = dict(common, job_id=job_id)
+        for field in test_fields:
+            doc[field] = _as_text(test.get(field))
+        docs.append((_index('test', now), doc))
+
+    if settings.KCING_LOG_CHUNK > 0:
+        for chunk in _log_chunks(logs, settings.KCING_LOG_CHUNK):
+            doc = dict(common, job_id=job_id)
+            for field in log_chunk_fields:
+                doc[field] = chunk[field]
+            docs.append((_index('log', now), doc))
+    else:
+        for _log in logs:
+            doc = dict(common, job_id=job_id)
+            for field in log_fields:
+                doc[field] = _as_text(_log.get(field))
+            docs.append((_index('log', now), doc))
+
+    return docs
+
+
+def _boot_docs(boot, now):
+    boot.pop('fastboot', None)
+    if 'boot_result' in boot:
+        boot['boot_result'] = _as_text(boot['boot_result']).lower()
+    boot.setdefault('git_describe', boot.get('kernel'))
+    boot['@timestamp'] = _timestamp(now)
+    return [(_index('boot', now), boot)]
+
+
+def _build_docs(build, now):
+    build['@timestamp'] = _timestamp(now)
+    return [(_index('build', now), build)]
+
+
+def doc_ids(oid, docs):
+    """
+    Deterministic ids of documents spanned out of the file of kernelci object `oid`, the same
+    ids kcing_pipeline.conf gives them, so that sending a file twice overwrites its documents:
+    boots and builds are `oid`, tests `oid-t-N` (N-th result) and logs `oid-l-LINENO`
+    """
+    ids = []
+    seq = 0
+    for index, doc in docs:
+        if index.startswith('test-'):
+            ids.append('%s-t-%i' % (oid, seq))
+            seq += 1
+        elif index.startswith('log-'):
+            ids.append('%s-l-%s' % (oid, doc.get('lineno_start', doc.get('lineno'))))
+        else:
+            ids.append(oid)
+    return ids
+
+
+def transform(_type, content, now=None):
+    """
+    Transform the content of a lava, build or boot file into a list
+    of (index, document) ready to be sent to ES, or raise InvalidDocument
+    """
+    now = now or datetime.utcnow()
+
+    try:
+        doc = json.loads(content)
+    except ValueError as e:
+        raise InvalidDocument('Not a json document: %s' % (e))
+
+    if not isinstance(doc, dict):
+        raise InvalidDocument('Expected a json object')
+
+    for field in ['headers', '@version', 'token', 'type']:
+        doc.pop(field, None)
+
+    transformers = {
+        'lava': _lava_docs,
+        'boot': _boot_docs,
+        'build': _build_docs,
+    }
+
+    try:
+        return transformers[_type](doc, now)
+    except (yaml.YAMLError, KeyError, TypeError, AttributeError) as e:
+        raise InvalidDocument('Failed to transform %s: %s' % (_type, e))
+
+
+def transform_file(_type, file_name):
+    """Same as transform, but reading from a file. Returns None if the file can't be transformed"""
+    try:
+        with open(file_name, 'r') as file_handler:
+            return transform(_type, file_handler.read())
+    except (OSError, InvalidDocument) as e:
+        logger.error('Could not transform %s: %s' % (file_name, e))
+        return None
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Counters and latency histograms of every feed_es stage (listing, downloads,
+# posts, sqlite...), exported as a Prometheus text file and/or a json summary
+# so it's possible to tell whether kernelci.org, disk or logstash is slowing kcing down
+
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import settings
+
+logger = logging.getLogger()
+
+# Upper bounds, in seconds, of histogram buckets
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+server = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add value to a counter"""
+    with lock:
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    """Set a gauge"""
+    with lock:
+        gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Record a value, usually seconds, in a histogram"""
+    with lock:
+        key = _key(name, labels)
+        if key not in histograms:
+            histograms[key] = {'buckets': [0] * len(buckets), 'count': 0, 'sum': 0, 'max': 0}
+
+        histogram = histograms[key]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['max'] = max(histogram['max'], value)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe how long the block takes, even if it raises"""
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - started, **labels)
+
+
+@contextmanager
+def stage(name):
+    """Wall-clock timer of a main stage of a command, logged and kept in kcing_stage_seconds"""
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        observe('kcing_stage_seconds', elapsed, stage=name)
+        logger.info('Stage "%s" took %.2f seconds' % (name, elapsed))
+
+
+def reset():
+    with lock:
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+
+
+def _labels(labels, extra=None):
+    labels = list(labels) + (extra or [])
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels))
+
+
+def prometheus():
+    """Render all metrics in Prometheus text exposition format"""
+    lines = []
+    typed = []
+    with lock:
+        for kind, metrics in [('counter', counters), ('gauge', gauges)]:
+            for (name, labels), value in sorted(metrics.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    typed.append(name)
+                lines.append('%s%s %s' % (name, _labels(labels), value))
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append('# TYPE %s histogram' % (name))
+                typed.append(name)
+            for bound, count in zip(buckets, histogram['buckets']):
+                lines.append('%s_bucket%s %i' % (name, _labels(labels, [('le', bound)]), count))
+            lines.append('%s_bucket%s %i' % (name, _labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('%s_sum%s %f' % (name, _labels(labels), histogram['sum']))
+            lines.append('%s_count%s %i' % (name, _labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """All metrics as a dict of `name{labels}` -> value, histograms are summarized as count/sum/avg/max"""
+    result = {}
+    with lock:
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            result[name + _labels(labels)] = value
+
+        for (name, labels), histogram in histograms.items():
+            result[name + _labels(labels)] = {
+                'count': histogram['count'],
+                'sum': round(histogram['sum'], 6),
+                'avg': round(histogram['sum'] / histogram['count'], 6),
+                'max': round(histogram['max'], 6),
+            }
+
+    return dict(sorted(result.items()))
+
+
+def log_summary():
+    """Log how much time went into each stage"""
+    for name, value in summary().items():
+        if type(value) is dict:
+            logger.info('%s: %i in %.2fs (avg %.3fs, max %.3fs)' % (name, value['count'], value['sum'], value['avg'], value['max']))
+        else:
+            logger.info('%s: %s' % (name, value))
+
+
+def _write(file_name, content):
+    # Prometheus' textfile collector might read it at any time, so never leave it half written
+    temp_name = '%s.%i.tmp' % (file_name, os.getpid())
+    with open(temp_name, 'w') as fh:
+        fh.write(content)
+    os.replace(temp_name, file_name)
+
+
+def write(prometheus_file=None, json_file=None):
+    """Save metrics to KCING_METRICS_FILE (Prometheus) and KCING_METRICS_JSON, when set"""
+    prometheus_file = prometheus_file or settings.KCING_METRICS_FILE
+    json_file = json_file or settings.KCING_METRICS_JSON
+
+    try:
+        if prometheus_file:
+            _write(prometheus_file, prometheus())
+            logger.info('Metrics saved to %s' % (prometheus_file))
+
+        if json_file:
+            _write(json_file, json.dumps(summary(), indent=2))
+            logger.info('Metrics summary saved to %s' % (json_file))
+    except OSError as e:
+        logger.error('Failed to save metrics: %s' % (e))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith('/metrics.json'):
+            content, content_type = json.dumps(summary(), indent=2), 'application/json'
+        elif self.path.startswith('/metrics'):
+            content, content_type = prometheus(), 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+
+        content = content.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(port=None):
+    """Serve live metrics at /metrics (Prometheus) and /metrics.json, in a background thread"""
+    global server
+    port = port or settings.KCING_METRICS_PORT
+    if not port or server is not None:
+        return
+
+    try:
+        server = ThreadingHTTPServer(('', port), MetricsHandler)
+    except OSError as e:
+        logger.error('Failed to serve metrics on port %i: %s' % (port, e))
+        return
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Serving metrics on port %i' % (port))
@@ -2,11 +2,17 @@ import os
 import logging
 from datetime import datetime, timedelta
 
-from peewee import SqliteDatabase, Model, DateTimeField, CharField
+from peewee import SqliteDatabase, Model, DateTimeField, CharField, IntegerField, chunked, fn
+import metrics
 import settings
 
 logger = logging.getLogger()
-kcingdb = SqliteDatabase(settings.KCING_DB)
+
+# WAL lets readers and the writer work at the same time and makes commits cheaper
+kcingdb = SqliteDatabase(settings.KCING_DB, pragmas={'journal_mode': 'wal', 'synchronous': 'normal'})
+
+# Keep number of sql variables per query below sqlite's limit
+max_vars = 500
 
 class BaseModel(Model):
     class Meta:
@@ -14,12 +20,45 @@ class BaseModel(Model):
 
 
 class Object(BaseModel):
-    # The combination _type + oid should be unique!
     _type = CharField(column_name='type')
     oid = CharField()
     created_on = DateTimeField(default=datetime.now)
 
-tables = [Object,]
+    class Meta:
+        # The combination _type + oid should be unique!
+        indexes = ((('_type', 'oid'), True),)
+
+class Watermark(BaseModel):
+    # Most recent KernelCI doc processed of each type
+    _type = CharField(column_name='type', unique=True)
+    oid = CharField()
+    created_on = DateTimeField()
+
+class Failure(BaseModel):
+    # Objects that failed to download or to be posted, retried with exponential backoff
+    _type = CharField(column_name='type')
+    oid = CharField()
+    stage = CharField()
+    # Download link, or downloaded file name when stage is 'post'
+    url = CharField()
+    attempts = IntegerField(default=0)
+    next_attempt = DateTimeField()
+    created_on = DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = ((('_type', 'oid', 'stage'), True),)
+
+class Digest(BaseModel):
+    # Digest of the content of objects sent to ES, the same content showing up under another oid is skipped
+    _type = CharField(column_name='type')
+    digest = CharField()
+    oid = CharField()
+    created_on = DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = ((('_type', 'digest'), True),)
+
+tables = [Object, Watermark, Failure, Digest,]
 
 
 def create_tables():
@@ -33,8 +72,27 @@ def init():
         
     kcingdb.connect(reuse_if_open=True)
 
-    if new_db: 
-        create_tables()
+    # Older databases might have duplicates, which prevent the unique index from being created
+    if Object.table_exists() and not _has_unique_index(Object, ['type', 'oid']):
+        _delete_duplicates()
+
+    # Tables and indexes are created only if they don't exist, this also
+    # brings older databases up to date with new tables
+    create_tables()
+
+
+def _has_unique_index(model, columns):
+    for index in kcingdb.get_indexes(model._meta.table_name):
+        if index.unique and index.columns == columns:
+            return True
+    return False
+
+
+def _delete_duplicates():
+    keep = Object.select(fn.MIN(Object.id)).group_by(Object._type, Object.oid)
+    deleted = Object.delete().where(Object.id.not_in(keep)).execute()
+    if deleted:
+        logger.info('%i duplicate objects deleted' % (deleted))
 
 
 def end():
@@ -48,6 +106,15 @@ def all_objs(_type):
     return objs
 
 
+def existing(_types, oids):
+    """Return which of oids were already processed as any of _types, without loading all of them"""
+    found = set()
+    for chunk in chunked(oids, max_vars):
+        query = Object.select(Object.oid).where(Object._type.in_(_types), Object.oid.in_(chunk))
+        found.update(o.oid for o in query)
+    return found
+
+
 def save(_type, objs):
     if len(objs) == 0:
         return 0
@@ -56,12 +123,108 @@ def save(_type, objs):
     for _id in objs.keys():
         prepared_data.append({'_type': _type, 'oid': _id})
 
-    with kcingdb.atomic():
-        inserted = Object.insert_many(prepared_data).execute()
+    # Saving the same object twice is harmless
+    inserted = 0
+    with metrics.timer('kcing_db_save_seconds'), kcingdb.atomic():
+        for chunk in chunked(prepared_data, max_vars // 2):
+            inserted += Object.insert_many(chunk).on_conflict_ignore().as_rowcount().execute()
+
+    metrics.inc('kcing_db_saved_total', inserted, type=_type)
+    return inserted
 
+
+def ingested(_type, digests):
+    """Return {digest: oid} of digests whose content was already sent to ES as _type"""
+    found = {}
+    for chunk in chunked(digests, max_vars):
+        query = Digest.select(Digest.digest, Digest.oid).where(Digest._type == _type, Digest.digest.in_(chunk))
+        found.update({d.digest: d.oid for d in query})
+    return found
+
+
+def save_digests(_type, digests):
+    """Record digests ({oid: digest}) of content sent to ES, first oid to send some content keeps it"""
+    if len(digests) == 0:
+        return 0
+
+    prepared_data = [{'_type': _type, 'digest': digest, 'oid': oid} for oid, digest in digests.items()]
+
+    inserted = 0
+    with kcingdb.atomic():
+        for chunk in chunked(prepared_data, max_vars // 3):
+            inserted += Digest.insert_many(chunk).on_conflict_ignore().as_rowcount().execute()
     return inserted
 
 
+def get_watermark(_type):
+    """Return (created_on, oid) of the most recent doc processed of _type, or None"""
+    watermark = Watermark.get_or_none(Watermark._type == _type)
+    if watermark is None:
+        return None
+
+    return watermark.created_on, watermark.oid
+
+
+def set_watermark(_type, created_on, oid):
+    Watermark.replace(_type=_type, created_on=created_on, oid=oid).execute()
+
+
+def record_failures(_type, stage, objs, attempted=True):
+    """
+    Record that objs ({oid: url}) failed at `stage` ('download' or 'post'), scheduling their
+    next attempt with exponential backoff. Returns oids that exceeded KCING_MAX_ATTEMPTS.
+    Objs that were not even attempted are due right away and don't count as an attempt
+    """
+    given_up = []
+    now = datetime.now()
+    with kcingdb.atomic():
+        for oid, url in objs.items():
+            failure = Failure.get_or_none(Failure._type == _type, Failure.oid == oid, Failure.stage == stage)
+            if failure is None:
+                failure = Failure(_type=_type, oid=oid, stage=stage)
+
+            failure.url = url
+            if attempted:
+                failure.attempts += 1
+                failure.next_attempt = now + timedelta(seconds=settings.KCING_RETRY_INTERVAL * 2 ** (failure.attempts - 1))
+            else:
+                failure.next_attempt = now
+            failure.save()
+
+            if failure.attempts >= settings.KCING_MAX_ATTEMPTS:
+                given_up.append(oid)
+
+    return given_up
+
+
+def due_failures(_type, stage):
+    """Return {oid: url} of failures at `stage` that are due to be retried"""
+    query = Failure.select().where(Failure._type == _type,
+                                   Failure.stage == stage,
+                                   Failure.attempts < settings.KCING_MAX_ATTEMPTS,
+                                   Failure.next_attempt <= datetime.now())
+    return {f.oid: f.url for f in query}
+
+
+def pending_failures(_types, stage, oids):
+    """Return which of oids failed at `stage` and are either waiting for their next attempt or given up"""
+    pending = set()
+    for chunk in chunked(oids, max_vars):
+        query = Failure.select(Failure.oid).where(Failure._type.in_(_types),
+                                                  Failure.stage == stage,
+                                                  Failure.oid.in_(chunk),
+                                                  (Failure.attempts >= settings.KCING_MAX_ATTEMPTS) | (Failure.next_attempt > datetime.now()))
+        pending.update(f.oid for f in query)
+    return pending
+
+
+def clear_failures(_type, stage, oids):
+    cleared = 0
+    for chunk in chunked(oids, max_vars):
+        cleared += Failure.delete().where(Failure._type == _type, Failure.stage == stage, Failure.oid.in_(chunk)).execute()
+    return cleared
+
+
 def delete_old(days=None):
     """
     The default number of days to keep lava/builds is 3. This is because
@@ -84,6 +247,13 @@ def delete_old(days=None):
 
     deleted = Object.delete().where(Object.created_on < drp_datetime).execute()
     logger.info('%i objects deleted' % (deleted))
+
+    digests = Digest.delete().where(Digest.created_on < drp_datetime).execute()
+    logger.info('%i digests deleted' % (digests))
+
+    # Objects that kept failing are given up for good after a while
+    expired = Failure.delete().where(Failure.created_on < drp_datetime).execute()
+    logger.info('%i failures deleted' % (expired))
     return deleted
 
 
@@ -3,25 +3,28 @@
 import os
 import logging
 import pathlib
-import requests
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import dirname, realpath, join
 
 from kernelci import KernelCI
+import metrics
 import settings
+import transport
 
 logger = logging.getLogger()
-client = None
 non_lava_lab = settings.KCI_NON_LAVA_LAB
 SAMPLES_DIR = join(dirname(realpath(__file__)), 'samples')
 
+# Files are downloaded in chunks to `.<file name>.<random>.part` files
+chunk_size = 64 * 1024
+part_suffix = '.part'
 
-def _client():
-    global client
-    if client is None:
-        client = requests.session()
-        client.headers['Connection'] = 'keep-alive'
 
-    return client
+def _client():
+    # Storage gets a pool of KCI_DOWNLOAD_WORKERS connections, see transport
+    return transport.client()
 
 
 def _is_samples_dir_ok(samples_dir):
@@ -39,42 +42,80 @@ def _is_samples_dir_ok(samples_dir):
     return True
 
 
-def _persist_samples(sample_type, objs, samples_dir):
+def _download_sample(sample_type, _id, download_link, samples_dir):
+    """
+    Download a single sample to samples_dir, returns a tuple with the
+    saved file name (None if download failed) and the link actually used
+    """
+    # lab-baylibre-seattle doesn't have lava-json*.json files, only boot*.json
+    # so this is a hacky way of making this
+    if non_lava_lab in download_link:
+        sample_type = 'boot'
+        download_link = download_link.replace('lava-json-', 'boot-')
+        logger.info('Non-lava lab detected (%s), switching lava-json- file to boot- file' % (download_link))
+
+    file_name = '%s_%s.json' % (sample_type, _id)
+    temp_name = None
+    started = time.time()
+    spooling = 0
+    try:
+        logger.debug('Downloading "%s"' % (download_link))
+        with _client().get(download_link, stream=True) as response:
+            if response.status_code != 200:
+                logger.error('Failed to download "%s" due to HTTP response: status_code = %i' % (download_link, response.status_code))
+                metrics.inc('kcing_downloads_total', type=sample_type, result='failed')
+                return None, download_link
+
+            # Write chunks to a temporary file and only then give it its final name, so
+            # a killed run never leaves a truncated file behind for _load_leftovers
+            written = 0
+            with tempfile.NamedTemporaryFile(dir=samples_dir, prefix='.%s.' % (file_name), suffix=part_suffix, delete=False) as file_handler:
+                temp_name = file_handler.name
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    spool_started = time.time()
+                    file_handler.write(chunk)
+                    spooling += time.time() - spool_started
+                    written += len(chunk)
+
+        os.replace(temp_name, join(samples_dir, file_name))
+    except:
+        logger.error('Failed to download "%s" due to connection issues' % (download_link))
+        metrics.inc('kcing_downloads_total', type=sample_type, result='failed')
+        if temp_name is not None and os.path.isfile(temp_name):
+            os.unlink(temp_name)
+        return None, download_link
+
+    logger.debug('Written %i bytes to %s' % (written, file_name))
+    metrics.observe('kcing_download_seconds', time.time() - started, type=sample_type)
+    metrics.observe('kcing_spool_write_seconds', spooling, type=sample_type)
+    metrics.inc('kcing_downloads_total', type=sample_type, result='ok')
+    metrics.inc('kcing_download_bytes_total', written, type=sample_type)
+    return file_name, download_link
+
+
+def _persist_samples(sample_type, objs, samples_dir, workers=None):
     if len(objs) == 0:
         logger.warning('Persisting %s skipped due to empty list of objects' % (sample_type))
         return {}, {}
 
+    workers = workers or settings.KCI_DOWNLOAD_WORKERS
+    logger.debug('Downloading %i %s files using %i workers' % (len(objs), sample_type, workers))
+
     failed = {}
     saved = {}
-    for _id in objs.keys():
-        temp_sample_type = sample_type
-        download_link = objs[_id]
-        try:
-            # lab-baylibre-seattle doesn't have lava-json*.json files, only boot*.json
-            # so this is a hacky way of making this
-            if non_lava_lab in download_link:
-                temp_sample_type = 'boot'
-                download_link = download_link.replace('lava-json-', 'boot-')
-                logger.info('Non-lava lab detected (%s), switching lava-json- file to boot- file' % (download_link))
-
-            logger.debug('Downloading "%s"' % (download_link))
-            response = _client().get(download_link)
-        except:
-            logger.error('Failed to download "%s" due to connection issues' % (download_link))
-            failed[_id] = download_link
-            continue
-
-        if response.status_code != 200:
-            logger.error('Failed to download "%s" due to HTTP response: status_code = %i' % (download_link, response.status_code))
-            failed[_id] = download_link
-            continue
-        
-        file_name = '%s_%s.json' % (temp_sample_type, _id)
-        file_content = response.content.decode()
-        with open('%s/%s' % (samples_dir, file_name), 'w') as file_handler:
-            file_handler.write(file_content)
-            logger.debug('Written %i bytes to %s' % (len(file_content), file_name))
-            saved[_id] = file_name
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for _id in objs.keys():
+            future = executor.submit(_download_sample, sample_type, _id, objs[_id], samples_dir)
+            futures[future] = _id
+
+        for future in as_completed(futures):
+            _id = futures[future]
+            file_name, download_link = future.result()
+            if file_name is None:
+                failed[_id] = download_link
+            else:
+                saved[_id] = file_name
 
     return saved, failed
 
@@ -93,13 +134,15 @@ def gen(args):
 
     kci = KernelCI()
 
-    lavas = kci.get_lavas(how_many=args.sample_size)
-    builds = kci.get_builds(how_many=args.sample_size)
+    with metrics.stage('listing'):
+        lavas = kci.get_lavas(how_many=args.sample_size)
+        builds = kci.get_builds(how_many=args.sample_size)
 
     logger.info('Retrieved %i lavas and %i builds from KernelCI' % (len(lavas), len(builds)))
 
-    saved_lavas, failed_lavas = _persist_samples('lava', lavas, samples_dir)
-    saved_builds, failed_builds = _persist_samples('build', builds, samples_dir)
+    with metrics.stage('download'):
+        saved_lavas, failed_lavas = _persist_samples('lava', lavas, samples_dir)
+        saved_builds, failed_builds = _persist_samples('build', builds, samples_dir)
 
     # Check if there were any non-lava switches
     saved_boots = [v for v in saved_lavas.values() if v.startswith('boot')]
@@ -1,5 +1,6 @@
 # Settings file for KCING
 
+import os
 from os import getenv
 from os.path import dirname, join, isfile
 
@@ -16,22 +17,74 @@ KCI_HOST   = env_or_local('KCI_HOST', 'kernelci.org')
 KCI_SCHEME = env_or_local('KCI_SCHEME', 'https')
 KCI_NON_LAVA_LAB = env_or_local('KCI_NON_LAVA_LAB', 'lab-baylibre-seattle')
 
-# ES links, it's actually logstash listening to those handlers
+# Where lava/build files are downloaded from, defaults to storage.KCI_HOST
+KCI_STORAGE_URL = env_or_local('KCI_STORAGE_URL', '%s://storage.%s' % (KCI_SCHEME, KCI_HOST))
+
+# Minutes to go back from the last processed doc when listing KernelCI incrementally
+KCI_SYNC_OVERLAP = int(env_or_local('KCI_SYNC_OVERLAP', 60))
+
+# Number of listing pages to retrieve from KernelCI at the same time
+KCI_LISTING_WORKERS = int(env_or_local('KCI_LISTING_WORKERS', 4))
+
+# Number of lava/build files to download from storage at the same time
+KCI_DOWNLOAD_WORKERS = int(env_or_local('KCI_DOWNLOAD_WORKERS', 8))
+
+# Http transport: default timeouts (seconds), retries of connection errors and 429/502/503/504
+# responses with jittered exponential backoff (Retry-After takes precedence), and connection pool sizes.
+# KCING_HTTP_POOL_SIZES overrides the pool of specific base urls, e.g. "https://storage.kernelci.org=16,http://localhost:9200=4"
+KCING_HTTP_CONNECT_TIMEOUT = int(env_or_local('KCING_HTTP_CONNECT_TIMEOUT', 10))
+KCING_HTTP_TIMEOUT = int(env_or_local('KCING_HTTP_TIMEOUT', 120))
+KCING_HTTP_RETRIES = int(env_or_local('KCING_HTTP_RETRIES', 4))
+KCING_HTTP_BACKOFF = float(env_or_local('KCING_HTTP_BACKOFF', 1))
+KCING_HTTP_BACKOFF_MAX = float(env_or_local('KCING_HTTP_BACKOFF_MAX', 60))
+KCING_HTTP_POOL_SIZE = int(env_or_local('KCING_HTTP_POOL_SIZE', 10))
+KCING_HTTP_POOL_SIZES = env_or_local('KCING_HTTP_POOL_SIZES')
+
+# ES links, it's actually logstash listening to those handlers. Each of them might be a comma separated list of logstash nodes
 ES_HOST  = env_or_local('ES_HOST', 'http://localhost:9200')
 ES_LAVA  = env_or_local('ES_LAVA', 'http://localhost:8338')
 ES_BUILD = env_or_local('ES_BUILD', 'http://localhost:8337')
 ES_BOOT  = env_or_local('ES_BOOT', 'http://localhost:8007')
 
+# Number of consecutive lava log lines stored in each log document, 0 keeps one document per line
+KCING_LOG_CHUNK = int(env_or_local('KCING_LOG_CHUNK', 0))
+
+# Max number of documents per request to ES _bulk api, used by `feed_es --direct`
+ES_BULK_SIZE = int(env_or_local('ES_BULK_SIZE', 1000))
+
+# Number of processes transforming lava files when running `feed_es --direct`, defaults to number of cores
+KCING_TRANSFORM_WORKERS = int(env_or_local('KCING_TRANSFORM_WORKERS', os.cpu_count() or 1))
+
+# Logstash nodes failing to take documents are left aside for ES_EJECT_INTERVAL seconds before being health checked again
+ES_EJECT_INTERVAL = int(env_or_local('ES_EJECT_INTERVAL', 60))
+
 # If an attempt to send data to ES fails, retry for ES_MAX_RETRIES before giving up
-ES_MAX_RETRIES = env_or_local('ES_MAX_RETRIES', 3)
+ES_MAX_RETRIES = int(env_or_local('ES_MAX_RETRIES', 3))
 
-# Number of seconds to sleep after every LS_PIPELINE_BATCH_SIZE objects are sent to ES, thus reducing load on logstash
-ES_LOAD_INTERVAL = env_or_local('ES_LOAD_INTERVAL', 3)
+# Builds and boots can be posted in batches of at most ES_BATCH_SIZE documents and ES_BATCH_BYTES bytes,
+# only once logstash runs a kcing_pipeline.conf with the json_lines codec. By default they're posted one by one
+ES_BATCH_SIZE = int(env_or_local('ES_BATCH_SIZE', 1))
+ES_BATCH_BYTES = int(env_or_local('ES_BATCH_BYTES', 1024 * 1024))
+
+# Number of seconds to sleep after every LS_PIPELINE_BATCH_SIZE objects are sent to ES, thus reducing load on logstash.
+# This is only used when logstash stats api (LS_API) is not available
+ES_LOAD_INTERVAL = int(env_or_local('ES_LOAD_INTERVAL', 3))
+
+# Max number of seconds to wait between documents when logstash looks busy
+ES_MAX_LOAD_INTERVAL = int(env_or_local('ES_MAX_LOAD_INTERVAL', 30))
 
 # Logstash settings
 # Home folder of logstash
 LS_HOME                 = env_or_local('LS_HOME')
 
+# Logstash monitoring api, used to slow down sending documents when logstash is busy
+LS_API                  = env_or_local('LS_API', 'http://localhost:9600')
+LS_PIPELINE_ID          = env_or_local('LS_PIPELINE_ID', 'kcing')
+
+# Logstash is considered busy above this heap usage or number of queued events
+LS_MAX_HEAP_PERCENT     = int(env_or_local('LS_MAX_HEAP_PERCENT', 75))
+LS_MAX_QUEUED_EVENTS    = int(env_or_local('LS_MAX_QUEUED_EVENTS', 20))
+
 # Queueing type: persisted (disk) or memory (ram)
 LS_QUEUE_TYPE           = env_or_local('LS_QUEUE_TYPE', 'persisted')
 
@@ -47,8 +100,27 @@ LS_NUM_WORKERS = env_or_local('LS_NUM_WORKERS', 1)
 # Database to store progress of processed lavas/builds
 KCING_DB = env_or_local('KCING_DB', 'kcing.db')
 
+# Directory where lavas/builds are downloaded to before being sent to ES
+KCING_DATA_DIR = env_or_local('KCING_DATA_DIR', join(dirname(__file__), 'data'))
+
+# Lavas/builds failing to download or to be sent are retried up to KCING_MAX_ATTEMPTS times,
+# waiting KCING_RETRY_INTERVAL seconds before the first retry and twice as long after each new failure
+KCING_MAX_ATTEMPTS = int(env_or_local('KCING_MAX_ATTEMPTS', 5))
+KCING_RETRY_INTERVAL = int(env_or_local('KCING_RETRY_INTERVAL', 300))
+
 # Number of days to keep data in ES and kcing.db
 DRP_DAYS = env_or_local('DRP_DAYS', 4)
 
+# When running `watch`, feed ES every KCING_WATCH_INTERVAL seconds and apply
+# data retention policy every KCING_DRP_INTERVAL seconds
+KCING_WATCH_INTERVAL = int(env_or_local('KCING_WATCH_INTERVAL', 600))
+KCING_DRP_INTERVAL = int(env_or_local('KCING_DRP_INTERVAL', 24 * 60 * 60))
+
+# Per stage counters and latencies of feed_es are saved as a Prometheus text file to KCING_METRICS_FILE
+# and/or as a json summary to KCING_METRICS_JSON. `watch` also serves them live on KCING_METRICS_PORT
+KCING_METRICS_FILE = env_or_local('KCING_METRICS_FILE')
+KCING_METRICS_JSON = env_or_local('KCING_METRICS_JSON')
+KCING_METRICS_PORT = int(env_or_local('KCING_METRICS_PORT', 0))
+
 # Base url for the kibana site
 KB_URL = env_or_local('KB_URL', 'http://localhost:5601/app/kibana')
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# Generates ES index templates for boot, build, test and log indices out of a
+# declared schema, instead of letting almost every field be mapped as text
+# with a keyword subfield: identifiers are keyword only, numbers and dates get
+# their real types and norms are disabled
+
+import json
+import logging
+import re
+
+logger = logging.getLogger()
+
+kibana_filename = 'kcing.kibana'
+
+# Field kinds
+KEYWORD = 'keyword'
+TEXT = 'text'
+LONG = 'long'
+FLOAT = 'float'
+DATE = 'date'
+BOOLEAN = 'boolean'
+
+date_format = 'strict_date_optional_time||yyyy-MM-dd HH:mm:ss.SSS||yyyy-MM-dd HH:mm:ss||epoch_millis'
+
+# Fields every lava spans to boot, test and log documents
+common = {
+    '@timestamp': DATE,
+    'arch': KEYWORD,
+    'board': KEYWORD,
+    'boot_result': KEYWORD,
+    'boot_time': FLOAT,
+    'build_environment': KEYWORD,
+    'defconfig_full': KEYWORD,
+    'endian': KEYWORD,
+    'file_server_resource': KEYWORD,
+    'git_branch': KEYWORD,
+    'git_commit': KEYWORD,
+    'git_describe': KEYWORD,
+    'job': KEYWORD,
+    'kernel': KEYWORD,
+    'lab_name': KEYWORD,
+    'mach': KEYWORD,
+    'platform_name': KEYWORD,
+    'priority': LONG,
+}
+
+schema = {
+    'boot': dict(common, **{
+        'boot_log': KEYWORD,
+        'boot_log_html': KEYWORD,
+        'boot_retries': LONG,
+        'boot_warnings': LONG,
+        'defconfig': KEYWORD,
+        'dtb': KEYWORD,
+        'dtb_addr': KEYWORD,
+        'dtb_append': BOOLEAN,
+        'host': KEYWORD,
+        'initrd': KEYWORD,
+        'initrd_addr': KEYWORD,
+        'kernel_image': KEYWORD,
+        'loadaddr': KEYWORD,
+        'uimage_addr': KEYWORD,
+        'version': KEYWORD,
+    }),
+    'build': {
+        '@timestamp': DATE,
+        'arch': KEYWORD,
+        'build_environment': KEYWORD,
+        'build_log': KEYWORD,
+        'build_platform': KEYWORD,
+        'build_result': KEYWORD,
+        'build_threads': LONG,
+        'build_time': FLOAT,
+        'compiler': KEYWORD,
+        'compiler_version': KEYWORD,
+        'compiler_version_full': TEXT,
+        'cross_compile': KEYWORD,
+        'defconfig': KEYWORD,
+        'defconfig_full': KEYWORD,
+        'file_server_resource': KEYWORD,
+        'git_branch': KEYWORD,
+        'git_commit': KEYWORD,
+        'git_describe': KEYWORD,
+        'git_describe_v': KEYWORD,
+        'git_url': KEYWORD,
+        'host': KEYWORD,
+        'job': KEYWORD,
+        'kernel': KEYWORD,
+        'kernel_config': KEYWORD,
+        'kernel_image': KEYWORD,
+        'modules': KEYWORD,
+        'system_map': KEYWORD,
+        'text_offset': KEYWORD,
+        'vmlinux_bss_size': LONG,
+        'vmlinux_data_size': LONG,
+        'vmlinux_file_size': LONG,
+        'vmlinux_text_size': LONG,
+    },
+    'test': dict(common, **{
+        'id': KEYWORD,
+        'job_id': KEYWORD,
+        'level': KEYWORD,
+        'log_end_line': LONG,
+        'log_start_line': LONG,
+        'logged': DATE,
+        'measurement': FLOAT,
+        'name': KEYWORD,
+        'result': KEYWORD,
+        'suite': KEYWORD,
+        'unit': KEYWORD,
+    }),
+    'log': dict(common, **{
+        'dt': DATE,
+        'job_id': KEYWORD,
+        'lineno': LONG,
+        'lineno_end': LONG,
+        'lineno_start': LONG,
+        'lvl': KEYWORD,
+        'msg': TEXT,
+    }),
+}
+
+
+def kibana_keyword_fields(file_name=kibana_filename):
+    """Fields kibana saved objects refer to as `<field>.keyword`, they must keep that subfield"""
+    try:
+        with open(file_name, 'r') as fh:
+            return set(re.findall(r'([\w@]+)\.keyword', fh.read()))
+    except OSError as e:
+        logger.warning('Could not read %s, no keyword subfields will be kept: %s' % (file_name, e))
+        return set()
+
+
+def _field(kind, keyword_subfield=False):
+    if kind == KEYWORD:
+        # Aggregations go through `.keyword`, so there's no need for doc values in both
+        field = {'type': 'keyword', 'ignore_above': 256}
+        if keyword_subfield:
+            field['doc_values'] = False
+    elif kind == TEXT:
+        field = {'type': 'text', 'norms': False}
+    elif kind in [LONG, FLOAT]:
+        field = {'type': kind, 'ignore_malformed': True}
+    elif kind == DATE:
+        field = {'type': 'date', 'format': date_format, 'ignore_malformed': True}
+    else:
+        field = {'type': kind}
+
+    if keyword_subfield:
+        field['fields'] = {'keyword': {'type': 'keyword', 'ignore_above': 256}}
+
+    return field
+
+
+def generate(index_type, best_compression=False, keyword_fields=None):
+    """Build the index template of index_type out of its schema"""
+    if keyword_fields is None:
+        keyword_fields = kibana_keyword_fields()
+
+    settings = {'number_of_shards': 1}
+    if best_compression:
+        settings['codec'] = 'best_compression'
+
+    properties = {}
+    for name, kind in sorted(schema[index_type].items()):
+        properties[name] = _field(kind, name in keyword_fields)
+
+    return {
+        'index_patterns': ['%s-*' % (index_type)],
+        'settings': settings,
+        'mappings': {
+            # Fields not in the schema are most likely identifiers too
+            'dynamic_templates': [{
+                'strings': {
+                    'match_mapping_type': 'string',
+                    'mapping': {'type': 'keyword', 'ignore_above': 256},
+                },
+            }],
+            'properties': properties,
+        },
+    }
+
+
+def dumps(template):
+    return json.dumps(template, sort_keys=True, indent=2)
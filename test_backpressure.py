@@ -0,0 +1,94 @@
+#/usr/bin/env python3
+
+import unittest
+import logging
+import json
+
+from unittest.mock import MagicMock, patch
+
+import settings
+from backpressure import Backpressure
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def stats(queued=0, heap=10):
+    content = {
+        'jvm': {'mem': {'heap_used_percent': heap}},
+        'pipelines': {settings.LS_PIPELINE_ID: {'queue': {'events_count': queued}}},
+    }
+    return MagicMock(status_code=200, content=json.dumps(content).encode())
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.throttle = Backpressure(self.client, fallback_every=2)
+
+    def wait(self):
+        # Make sure stats get polled every time
+        self.throttle.last_poll = 0
+        with patch('time.sleep') as sleep:
+            self.throttle.wait()
+        return sleep.call_args[0][0] if sleep.called else 0
+
+    def test_idle(self):
+        self.client.get.return_value = stats()
+        self.assertEqual(self.wait(), 0)
+        self.assertEqual(self.wait(), 0)
+
+    def test_busy(self):
+        self.client.get.return_value = stats(heap=90)
+        self.assertEqual(self.wait(), self.throttle.min_delay)
+        self.assertEqual(self.wait(), self.throttle.min_delay * 2)
+
+        self.client.get.return_value = stats(queued=settings.LS_MAX_QUEUED_EVENTS)
+        self.assertEqual(self.wait(), self.throttle.min_delay * 4)
+
+        # Logstash is back to normal
+        self.client.get.return_value = stats()
+        self.assertEqual(self.wait(), self.throttle.min_delay * 2)
+
+    def test_slow_posts(self):
+        # Stats showing an idle logstash win over slow posts
+        self.client.get.return_value = stats()
+        self.throttle.record(0.1)
+        self.throttle.record(2)
+        self.assertEqual(self.wait(), 0)
+
+        # Without stats, posts are slower than usual
+        self.throttle.stats_available = False
+        self.throttle.fallback_every = None
+        self.assertEqual(self.wait(), self.throttle.min_delay)
+
+    def test_latency_per_byte(self):
+        self.client.get.side_effect = Exception('no stats')
+        self.throttle.fallback_every = None
+
+        # Big lavas taking longer than small batches of builds are not slow
+        for i in range(5):
+            self.throttle.record(0.005, 2000, 'build')
+            self.throttle.record(0.08, 400000, 'lava')
+            self.assertEqual(self.wait(), 0)
+
+        # The fastest post fades away
+        fastest = self.throttle.fastest['lava']
+        self.throttle.record(1, 400000, 'lava')
+        self.assertTrue(self.throttle.fastest['lava'] > fastest)
+        self.assertEqual(self.wait(), self.throttle.min_delay)
+
+    def test_fallback(self):
+        self.client.get.side_effect = Exception('no stats')
+        self.assertEqual(self.wait(), 0)
+        self.assertEqual(self.wait(), settings.ES_LOAD_INTERVAL)
+        self.assertFalse(self.throttle.stats_available)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#/usr/bin/env python3
+
+import unittest
+import logging
+
+from unittest.mock import patch
+
+import balancer
+from balancer import Balancer
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+urls = ['http://ls1:8338', 'http://ls2:8338', 'http://ls3:8338']
+
+
+class TestBalancer(unittest.TestCase):
+
+    def setUp(self):
+        self.down = set()
+        self.balancer = Balancer(urls, lambda url: url not in self.down, eject_for=60)
+
+    def test_split_urls(self):
+        self.assertEqual(balancer.split_urls('http://ls1:8338, http://ls2:8338,'), urls[:2])
+        self.assertEqual(balancer.split_urls('http://ls1:8338'), urls[:1])
+
+    def test_round_robin(self):
+        picked = []
+        for i in range(6):
+            url = self.balancer.acquire()
+            picked.append(url)
+            self.balancer.release(url)
+
+        self.assertEqual(picked, urls + urls)
+
+    def test_least_outstanding(self):
+        first = self.balancer.acquire()
+        second = self.balancer.acquire()
+        self.balancer.release(first)
+
+        # The one still busy is left alone
+        for i in range(4):
+            url = self.balancer.acquire()
+            self.assertNotEqual(url, second)
+            self.balancer.release(url)
+
+    def test_eject(self):
+        with patch.object(balancer.time, 'time', return_value=1000):
+            url = self.balancer.acquire()
+            self.balancer.release(url, healthy=False)
+            self.assertEqual(self.balancer.healthy(), [u for u in urls if u != url])
+
+            # Excluded nodes are not picked either
+            self.assertIsNone(self.balancer.acquire(exclude=urls))
+
+        # It's brought back once its time is up, if it looks healthy
+        self.down.add(url)
+        with patch.object(balancer.time, 'time', return_value=1061):
+            self.assertNotIn(url, self.balancer.healthy())
+
+        self.down.clear()
+        with patch.object(balancer.time, 'time', return_value=1122):
+            self.assertEqual(self.balancer.healthy(), urls)
+
+    def test_check_all(self):
+        self.down.update(urls[:2])
+        self.assertEqual(self.balancer.check_all(), 1)
+        self.assertEqual(self.balancer.acquire(), urls[2])
+
+        # The last node is kept around, so there's always somewhere to send to
+        self.down.update(urls)
+        self.assertEqual(self.balancer.check_all(), 0)
+        self.assertEqual(self.balancer.acquire(), urls[2])
+
+    def test_keeps_last_node(self):
+        single = Balancer(urls[:1], lambda url: False, eject_for=60)
+        url = single.acquire()
+        single.release(url, healthy=False)
+        self.assertEqual(single.healthy(), urls[:1])
+        self.assertEqual(single.acquire(), url)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
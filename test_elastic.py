@@ -6,7 +6,9 @@ import os
 import shutil
 import tempfile
 
+from datetime import datetime, timedelta
 from os.path import join, isfile
+from unittest.mock import MagicMock, patch
 
 import elastic as es
 import models
@@ -20,6 +22,14 @@ logger.setLevel(logging.INFO)
 class fake_args(object):
     pass
 
+def _transform_or_crash(_type, file_name):
+    """Stands in for lava.transform_file in transform workers"""
+    if 'crash' in file_name:
+        os._exit(1)
+    if 'raise' in file_name:
+        raise ValueError('unexpected')
+    return [('kcing-lava', {'file': file_name})]
+
 class TestElastic(unittest.TestCase):
 
     def setUp(self):
@@ -90,6 +100,35 @@ class TestElastic(unittest.TestCase):
         response = es._send('lava', 'does_not_exist', self.dir.name)
         self.assertFalse(response)
 
+    def test_send_batches(self):
+        objs = {}
+        for _id in ['1', '2', '3']:
+            objs[_id] = 'build_%s.json' % (_id)
+            with open(join(self.dir.name, objs[_id]), 'w') as fh:
+                fh.write('{\n  "_id": "%s"\n}' % (_id))
+
+        with patch.object(settings, 'ES_BATCH_SIZE', 2), patch.object(es, '_post_content', return_value=True) as post:
+            results = list(es._send_batches('build', objs, self.dir.name))
+
+        self.assertEqual(results, [(['1', '2'], True), (['3'], True)])
+        self.assertEqual(post.call_args_list[0][0][1], '{"_id":"1","kcing_id":"1"}\n{"_id":"2","kcing_id":"2"}\n')
+
+    def test_index_docs_ids(self):
+        docs = [('boot-2019.01.01', {}), ('test-2019.01.01', {}), ('test-2019.01.01', {}), ('log-2019.01.01', {'lineno': '1'})]
+
+        with patch.object(es, 'bulk', return_value=[]) as bulk:
+            self.assertTrue(es._index_docs('lava', docs, oid='5c0ffee'))
+        ids = [action['_id'] for action, doc in bulk.call_args[0][0]]
+        self.assertEqual(ids, ['5c0ffee', '5c0ffee-t-0', '5c0ffee-t-1', '5c0ffee-l-1'])
+
+        # Without a kernelci id, ES picks them
+        with patch.object(es, 'bulk', return_value=[]) as bulk:
+            self.assertTrue(es._index_docs('lava', docs))
+        self.assertNotIn('_id', bulk.call_args[0][0][0][0])
+
+        self.assertEqual(es._oid('/tmp/lava_5c0ffee.json'), '5c0ffee')
+        self.assertIsNone(es._oid('/tmp/my-lava.json'))
+
     def test_send_to_es(self):
         file_name = join(self.dir.name, 'lava_1.json')
         os.mknod(file_name)
@@ -100,6 +139,246 @@ class TestElastic(unittest.TestCase):
         self.assertEqual(len(failed), 0)
         self.assertEqual(len(models.all_objs('lava')), 1)
         self.assertFalse(isfile(file_name))
+
+    def test_post_content_failover(self):
+        nodes = ['http://ls1:8338', 'http://ls2:8338']
+        def post(url, data=None, **kwargs):
+            if url == nodes[0]:
+                raise es.transport.requests.ConnectionError('refused')
+            return MagicMock(status_code=200, content=b'ok')
+
+        balancer = es.Balancer(nodes, lambda url: True)
+        with patch.dict(es.balancers, {'lava': balancer}), patch.object(es, '_client') as client:
+            client().post.side_effect = post
+            self.assertTrue(es._post_content('lava', '{}'))
+            self.assertEqual(balancer.healthy(), nodes[1:])
+
+            # The last node is never ejected, failing over is up to the other ones
+            balancer.eject(nodes[1])
+            self.assertEqual(balancer.healthy(), nodes[1:])
+
+            # Nothing left to fail over to
+            nodes.reverse()
+            self.assertFalse(es._post_content('lava', '{}'))
+
+            # Nothing to even try
+            with patch.object(balancer, 'acquire', return_value=None):
+                self.assertIsNone(es._post_content('lava', '{}'))
+
+    def test_index_without_oid(self):
+        file_name = join(self.dir.name, 'my-build.json')
+        with open(file_name, 'w') as fh:
+            fh.write('{"kernel": "v5.0"}')
+
+        # Sending it again overwrites whatever made it to ES the first time
+        ids = []
+        for attempt in range(2):
+            with patch.object(es, 'bulk', return_value=[]) as bulk:
+                self.assertTrue(es._index('build', file_name))
+            ids.append(bulk.call_args[0][0][0][0]['_id'])
+
+        self.assertEqual(ids[0], es._digest(file_name))
+        self.assertEqual(ids[0], ids[1])
+
+    def test_shard(self):
+        objs = {'%024x' % (n): 'link' for n in range(100)}
+
+        shards = []
+        for i in range(3):
+            with patch.object(es, 'shard', (i, 3)):
+                shards.append(es._shard_objs(objs))
+
+        # Every oid belongs to one and only one shard
+        self.assertEqual(sum(len(s) for s in shards), len(objs))
+        self.assertEqual(set().union(*shards), set(objs))
+        for s in shards:
+            self.assertTrue(len(s) > 0)
+
+        self.assertEqual(es._shard_objs(objs), objs)
+
+    def test_send_to_es_shares_throttle(self):
+        throttle = MagicMock(slept=0)
+        with patch.object(settings, 'ES_BATCH_SIZE', 1), patch.object(es, 'Backpressure') as backpressure, \
+             patch.object(es, '_send', return_value=True):
+            for _type in ['lava', 'build']:
+                with open(join(self.dir.name, '%s_a%s.json' % (_type, _type)), 'w') as fh:
+                    fh.write('{"type": "%s"}' % (_type))
+                es._send_to_es(_type, {'a' + _type: '%s_a%s.json' % (_type, _type)}, self.dir.name, throttle=throttle)
+
+        backpressure.assert_not_called()
+        self.assertEqual(throttle.wait.call_count, 2)
+        self.assertIsNone(throttle.fallback_every)
+
+    def test_send_to_es_abort(self):
+        objs = {}
+        for n in range(6):
+            objs['c%i' % (n)] = 'lava_c%i.json' % (n)
+            with open(join(self.dir.name, objs['c%i' % (n)]), 'w') as fh:
+                fh.write('{"n": %i}' % (n))
+
+        # Same content as the last one, which is never tried
+        with open(join(self.dir.name, 'lava_c6.json'), 'w') as fh:
+            fh.write('{"n": 5}')
+
+        balancer = MagicMock()
+        balancer.healthy.return_value = []
+        with patch.object(es, '_send', return_value=False), patch.object(es, '_balancer', return_value=balancer):
+            passed, failed = es._send_to_es('lava', dict(objs, c6='lava_c6.json'), self.dir.name, throttle=MagicMock(slept=0))
+
+        # Files left behind by the abort, along with their duplicates, are due on next cycle
+        # without counting as an attempt
+        self.assertEqual(len(failed), 4)
+        untried = set(objs) - set(failed) | {'c6'}
+        self.assertEqual(len(untried), 3)
+        due = models.due_failures('lava', 'post')
+        self.assertTrue(untried <= set(due))
+        self.assertEqual({f.attempts for f in models.Failure.select().where(models.Failure.oid.in_(list(untried)))}, {0})
+        models.clear_failures('lava', 'post', list(objs.keys()) + ['c6'])
+
+    def test_send_to_es_no_node(self):
+        objs = {}
+        for n in range(4):
+            objs['e%i' % (n)] = 'lava_e%i.json' % (n)
+            with open(join(self.dir.name, objs['e%i' % (n)]), 'w') as fh:
+                fh.write('{"n": %i}' % (n))
+
+        # One post fails, then there's no logstash node to post the rest to
+        with patch.object(es, '_post_content', side_effect=[False, None, None, None]) as post, \
+             patch.object(es, '_balancer', return_value=MagicMock()):
+            passed, failed = es._send_to_es('lava', dict(objs), self.dir.name, throttle=MagicMock(slept=0))
+
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(passed, {})
+        self.assertEqual(list(failed), ['e0'])
+
+        # Files never posted don't count as an attempt
+        attempts = {f.oid: f.attempts for f in models.Failure.select().where(models.Failure.oid.in_(list(objs)))}
+        self.assertEqual(attempts, {'e0': 1, 'e1': 0, 'e2': 0, 'e3': 0})
+        models.clear_failures('lava', 'post', objs.keys())
+
+    def test_send_to_es_abort_drains(self):
+        objs = {}
+        for n in range(6):
+            objs['d%i' % (n)] = 'lava_d%i.json' % (n)
+            with open(join(self.dir.name, objs['d%i' % (n)]), 'w') as fh:
+                fh.write('{"n": %i}' % (n))
+
+        # Two logstash nodes, both down by the time the abort kicks in
+        balancer = MagicMock()
+        balancer.__len__.return_value = 2
+        balancer.healthy.return_value = []
+
+        def send(_type, obj, path=None):
+            if obj == 'lava_d2.json':
+                raise OSError('bad file')
+            return obj == 'lava_d4.json'
+
+        with patch.object(es, '_send', side_effect=send), patch.object(es, '_balancer', return_value=balancer):
+            passed, failed = es._send_to_es('lava', dict(objs), self.dir.name, throttle=MagicMock(slept=0))
+
+        # The post still in flight when aborting is waited for, instead of being left unrecorded
+        self.assertEqual(sorted(passed), ['d4'])
+        self.assertEqual(sorted(failed), ['d0', 'd1', 'd2', 'd3'])
+        self.assertEqual(models.existing(['lava'], objs.keys()), {'d4'})
+        self.assertIn('d5', models.due_failures('lava', 'post'))
+        models.clear_failures('lava', 'post', objs.keys())
+
+    def test_download_skips_pending_posts(self):
+        # abc failed to be sent and is waiting for its next attempt, abd was given up
+        models.record_failures('build', 'post', {'abc': 'build_abc.json', 'abd': 'build_abd.json'})
+        with patch.object(settings, 'KCING_MAX_ATTEMPTS', 1):
+            models.record_failures('build', 'post', {'abd': 'build_abd.json'})
+
+        listed = {'abc': 'http://storage/abc/build.json', 'abd': 'http://storage/abd/build.json', 'abe': 'http://storage/abe/build.json'}
+        with patch.object(es.samples, '_persist_samples', return_value=({'abe': 'build_abe.json'}, {})) as persist:
+            downloads = es._download('build', listed, self.dir.name, with_leftovers=False)
+
+        self.assertEqual(list(persist.call_args[0][1].keys()), ['abe'])
+        self.assertEqual(downloads, {'abe': 'build_abe.json'})
+        models.clear_failures('build', 'post', ['abc', 'abd'])
+
+    def test_watermarks(self):
+        args = fake_args()
+        args.full_scan = False
+        created_on = datetime(2019, 1, 1, 12)
+        models.set_watermark('build', created_on, 'b1')
+
+        kci = MagicMock(newest={})
+        since = es._watermarks(args, kci)
+        self.assertEqual(since['build'], created_on - timedelta(minutes=settings.KCI_SYNC_OVERLAP))
+        self.assertIsNone(since['lava'])
+
+        # Listing starts from the stored watermark, so it can only move forward
+        self.assertEqual(kci.newest, {'build': (created_on, 'b1')})
+
+    def test_watch_survives_crashes(self):
+        args = fake_args()
+        args.direct = True
+        args.shard = None
+
+        cycles = [OSError('disk full'), KeyboardInterrupt()]
+        with patch.object(es, '_is_es_ok', return_value=True), patch.object(es, '_is_data_dir_ok', return_value=True), \
+             patch.object(es, '_feed', side_effect=cycles) as feed, patch.object(es.metrics, 'serve'), \
+             patch.object(es.metrics, 'write'), patch.object(es.models, 'drp'), patch.object(es, 'drp'), \
+             patch.object(es.models, 'end'), patch.object(es.time, 'sleep'):
+            self.assertEqual(es.watch(args), 0)
+
+        # Leftovers are scanned again after a crash
+        self.assertEqual(feed.call_count, 2)
+        self.assertTrue(feed.call_args_list[1][0][2])
+
+    def test_index_all(self):
+        # Files transformed in 2 worker processes, one of them dies on the first file
+        names = ['crash'] + ['ok%i' % (n) for n in range(1, 5)] + ['raise', 'ok6', 'ok7']
+        objs = {'l%i' % (n): 'lava_%s.json' % (name) for n, name in enumerate(names)}
+
+        with patch.object(settings, 'KCING_TRANSFORM_WORKERS', 2), patch.object(es.lava, 'transform_file', _transform_or_crash), \
+             patch.object(es, 'bulk', return_value=[]):
+            results = {ids[0]: result for ids, result in es._index_all('lava', objs, self.dir.name)}
+
+        # Every file gets a result, files in flight when the worker died count as failed
+        # and the ones after it are picked up by a new pool
+        self.assertEqual(sorted(results), sorted(objs))
+        self.assertFalse(results['l0'])
+        self.assertFalse(results['l5'])
+        for _id in ['l4', 'l6', 'l7']:
+            self.assertTrue(results[_id])
+
+    def test_send_to_es_dedup(self):
+        objs = {}
+        for _id, content in [('a1', '{"n": 1}'), ('a2', '{"n": 2}'), ('a3', '{"n": 1}'), ('a4', '{"n": 3}')]:
+            objs[_id] = 'build_%s.json' % (_id)
+            with open(join(self.dir.name, objs[_id]), 'w') as fh:
+                fh.write(content)
+
+        # Content of a4 was sent before, under another id
+        models.save_digests('build', {'a0': es._digest(objs['a4'], self.dir.name)})
+
+        sent = []
+        def send(_type, obj, path=None, post=None):
+            sent.append(obj)
+            return True
+
+        with patch.object(es, '_send', side_effect=send):
+            passed, failed = es._send_to_es('build', dict(objs), self.dir.name, direct=True)
+
+        self.assertEqual(sorted(sent), ['build_a1.json', 'build_a2.json'])
+        self.assertEqual(sorted(passed), ['a1', 'a2'])
+        self.assertEqual(failed, {})
+        self.assertEqual(models.existing(['build'], objs.keys()), set(objs.keys()))
+        for _id in objs:
+            self.assertFalse(isfile(join(self.dir.name, objs[_id])))
+
+        # Duplicates of content that failed to be sent are retried later along with it
+        with open(join(self.dir.name, 'build_b1.json'), 'w') as fh, open(join(self.dir.name, 'build_b2.json'), 'w') as fh2:
+            fh.write('{"n": 4}')
+            fh2.write('{"n": 4}')
+
+        with patch.object(es, '_send', return_value=False):
+            passed, failed = es._send_to_es('build', {'b1': 'build_b1.json', 'b2': 'build_b2.json'}, self.dir.name, direct=True)
+
+        self.assertEqual(passed, {})
+        self.assertEqual(sorted(failed), ['b1', 'b2'])
         
 
 def main():
@@ -0,0 +1,45 @@
+#/usr/bin/env python3
+
+import unittest
+import logging
+
+from unittest.mock import MagicMock, patch
+
+import esbulk
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class TestEsBulk(unittest.TestCase):
+
+    def test_bulk(self):
+        content = b'{"errors": true, "items": [{"index": {"_id": "1", "status": 201}}, {"index": {"_id": "2", "status": 400, "error": "bad"}}]}'
+        response = MagicMock(status_code=200, content=content)
+        docs = [({'_index': 'build-2019.01.01'}, {'n': 1}), ({'_index': 'build-2019.01.01'}, {'n': 2})]
+
+        with patch.object(esbulk.transport, 'client') as client:
+            client().post.return_value = response
+            errors = esbulk.bulk(docs, chunk_size=2)
+
+        self.assertEqual(errors, [{'_id': '2', 'status': 400, 'error': 'bad'}])
+        lines = client().post.call_args[1]['data'].decode().splitlines()
+        self.assertEqual(lines, ['{"index": {"_index": "build-2019.01.01"}}', '{"n": 1}', '{"index": {"_index": "build-2019.01.01"}}', '{"n": 2}'])
+
+        # Without ids, documents could end up indexed twice if a request is sent again
+        self.assertFalse(client().post.call_args[1]['idempotent'])
+
+    def test_bulk_fails(self):
+        with patch.object(esbulk.transport, 'client') as client:
+            client().post.return_value = MagicMock(status_code=500, content=b'oops')
+            self.assertIsNone(esbulk.bulk([({'_index': 'build-2019.01.01', '_id': '1'}, {'n': 1})]))
+
+        self.assertTrue(client().post.call_args[1]['idempotent'])
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
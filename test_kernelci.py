@@ -3,12 +3,22 @@
 import unittest
 import logging
 
+from datetime import datetime, timedelta
+
+from unittest.mock import MagicMock, patch
+
+import requests
+
 from kernelci import KernelCI, CannotContinue
 
 
 logger = logging.getLogger()
 
 
+def doc(n):
+    return {'_id': {'$oid': str(n)}, 'created_on': {'$date': n * 1000}}
+
+
 class TestKernelCIMethods(unittest.TestCase):
 
     def setUp(self):
@@ -24,6 +34,18 @@ class TestKernelCIMethods(unittest.TestCase):
         # Make sure when blocking=False, no exception is raises
         self.kci._http('http://non123existing456url.dot.com', blocking=False)
         
+    def test_http_errors(self):
+        kci = KernelCI(max_retries=1)
+        with patch.object(kci, 'client') as client:
+            client.get.side_effect = requests.ConnectionError('refused')
+            with self.assertRaises(CannotContinue):
+                kci._http('http://localhost/lala')
+
+            # Anything but http errors is not swallowed
+            client.get.side_effect = KeyboardInterrupt()
+            with self.assertRaises(KeyboardInterrupt):
+                kci._http('http://localhost/lala', blocking=False)
+
     def test_refresh_csrf_token(self):
         token = self.kci._refresh_csrf_token()
         self.assertNotEqual(len(token), 0)
@@ -35,6 +57,77 @@ class TestKernelCIMethods(unittest.TestCase):
         builds = self.kci._get_docs('build', how_many=1)
         self.assertEqual(len(builds), 1)
 
+    def test_get_docs_keeps_order(self):
+        docs = [doc(0), doc(1), doc(2)]
+        get_page = lambda url, params, skip: docs[skip:skip + 1]
+
+        kci = KernelCI(max_retries=1, max_per_req=1, max_workers=3)
+        with patch.object(kci, '_refresh_csrf_token'), patch.object(kci, '_get_page', side_effect=get_page):
+            self.assertEqual(kci._get_docs('lava'), docs)
+            self.assertEqual(kci._get_docs('lava', how_many=2), docs[:2])
+            self.assertEqual(list(kci._iter_docs('lava')), [[docs[0]], [docs[1]], [docs[2]]])
+            self.assertEqual(kci.newest['lava'], (datetime.utcfromtimestamp(2), '2'))
+
+    def test_get_docs_since(self):
+        # Listing since a watermark comes newest first
+        docs = [doc(3), doc(2), doc(1), doc(0)]
+        get_page = lambda url, params, skip: docs[skip:skip + 2]
+
+        kci = KernelCI(max_retries=1, max_per_req=2, max_workers=3)
+        with patch.object(kci, '_refresh_csrf_token'), patch.object(kci, '_get_page', side_effect=get_page) as get_page:
+            since = datetime.utcfromtimestamp(2)
+            self.assertEqual(kci._get_docs('build', since=since), [doc(2), doc(3)])
+            self.assertEqual(get_page.call_args[0][1]['sort_order'], -1)
+
+    def test_watermark_waits_for_since(self):
+        docs = [doc(5), doc(4), doc(3), doc(2), doc(1), doc(0)]
+        since = datetime.utcfromtimestamp(1)
+
+        # Second page fails, docs 2 and 1 are never listed
+        def get_page(url, params, skip):
+            return None if skip == 2 else docs[skip:skip + 2]
+
+        kci = KernelCI(max_retries=1, max_per_req=2, max_workers=1)
+        kci.newest['build'] = (since, '1')
+        with patch.object(kci, '_refresh_csrf_token'), patch.object(kci, '_get_page', side_effect=get_page):
+            self.assertEqual(kci._get_docs('build', since=since), [doc(4), doc(5)])
+        self.assertEqual(kci.newest['build'], (since, '1'))
+
+        # Once listing gets back to since, the watermark moves
+        get_page = lambda url, params, skip: docs[skip:skip + 2]
+        with patch.object(kci, '_refresh_csrf_token'), patch.object(kci, '_get_page', side_effect=get_page):
+            self.assertEqual(len(kci._get_docs('build', since=since)), 5)
+            self.assertEqual(kci.newest['build'], (datetime.utcfromtimestamp(5), '5'))
+
+    def test_how_many_since(self):
+        docs = [doc(n) for n in range(11)]
+        def get_page(url, params, skip):
+            listed = docs if params['sort_order'] == 1 else list(reversed(docs))
+            return listed[skip:skip + params['limit']]
+
+        # Each limited run picks up where the last one stopped, the overlap with
+        # the watermark is listed again but doesn't count
+        kci = KernelCI(max_retries=1, max_per_req=2, max_workers=2)
+        kci.newest['build'] = (datetime.utcfromtimestamp(0), '0')
+        since = datetime.utcfromtimestamp(0)
+        with patch.object(kci, '_refresh_csrf_token'), patch.object(kci, '_get_page', side_effect=get_page):
+            listed = []
+            for run in range(4):
+                listed.append([d['_id']['$oid'] for d in kci._get_docs('build', how_many=3, since=since)])
+                since = kci.newest['build'][0] - timedelta(seconds=1)
+
+        self.assertEqual(listed, [['0', '1', '2', '3'], ['2', '3', '4', '5', '6'], ['5', '6', '7', '8', '9'], ['8', '9', '10']])
+        self.assertEqual(kci.newest['build'], (datetime.utcfromtimestamp(10), '10'))
+
+    def test_get_page_projects_fields(self):
+        response = MagicMock(status_code=200, content=b'{"result": []}')
+        with patch.object(self.kci, '_http', return_value=response) as http:
+            self.kci._get_page(self.kci.build_url, {'field': self.kci.doc_fields['build']}, 0)
+
+        url = http.call_args[0][0]
+        self.assertIn('field=_id&field=created_on&field=file_server_resource', url)
+        self.assertNotIn('lab_name', url)
+
     def test_get_lavas(self):
         links = self.kci.get_lavas(how_many=1)
         self.assertEqual(len(links), 1)
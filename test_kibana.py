@@ -0,0 +1,114 @@
+#/usr/bin/env python3
+
+import unittest
+import logging
+import json
+import os
+import tempfile
+
+from unittest.mock import MagicMock, patch
+
+import kibana
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class fake_args(object):
+    skip_unchanged = False
+
+
+class TestKibana(unittest.TestCase):
+
+    def setUp(self):
+        self.args = fake_args()
+        with open(kibana.kibana_filename) as fh:
+            self.objects = json.loads(kibana._replace_kibana_url(fh.read()))
+
+    def test_setup(self):
+        with patch.object(kibana, '_kibana_index', return_value='.kibana_1'), patch.object(kibana.esbulk, 'bulk', return_value=[]) as bulk:
+            self.assertEqual(kibana.setup(self.args), 0)
+
+        docs = bulk.call_args[0][0]
+        self.assertEqual(len(docs), len(self.objects))
+        self.assertEqual(docs[0], ({'_index': '.kibana_1', '_id': self.objects[0]['_id']}, self.objects[0]['_source']))
+
+        error = {'_id': self.objects[0]['_id'], 'status': 400, 'error': 'bad'}
+        with patch.object(kibana, '_kibana_index', return_value='.kibana_1'), patch.object(kibana.esbulk, 'bulk', return_value=[error]):
+            self.assertEqual(kibana.setup(self.args), -1)
+
+    def test_setup_skip_unchanged(self):
+        self.args.skip_unchanged = True
+
+        # All but the first object are already in kibana
+        docs = [{'_id': o['_id'], 'found': True, '_source': o['_source']} for o in self.objects[1:]]
+        docs.append({'_id': self.objects[0]['_id'], 'found': False})
+        response = MagicMock(status_code=200, content=json.dumps({'docs': docs}).encode())
+
+        with patch.object(kibana, '_kibana_index', return_value='.kibana_1'), \
+             patch.object(kibana.transport, 'client') as client, patch.object(kibana.esbulk, 'bulk', return_value=[]) as bulk:
+            client().post.return_value = response
+            self.assertEqual(kibana.setup(self.args), 0)
+
+        self.assertEqual([action['_id'] for action, doc in bulk.call_args[0][0]], [self.objects[0]['_id']])
+
+    def test_backup(self):
+        # As restored by setup_kbn, objects were written in the order they have in kcing.kibana
+        hits = json.loads(kibana._hide_kibana_url(json.dumps(self.objects)))
+        for seq_no, hit in enumerate(hits):
+            hit['sort'] = [hit['_source']['type'], seq_no]
+        hits.sort(key=lambda h: h['sort'])
+
+        def search(url, headers=None, data=None):
+            search = json.loads(data)
+            start = 0
+            if 'search_after' in search:
+                start = [h['sort'] for h in hits].index(search['search_after']) + 1
+            page = [dict(h) for h in hits[start:start + search['size']]]
+            return MagicMock(status_code=200, content=json.dumps({'hits': {'hits': page}}).encode())
+
+        def get(url, headers=None):
+            if '_alias' in url:
+                return MagicMock(status_code=200, content=b'{".kibana_2": {"aliases": {".kibana": {}}}}')
+            return MagicMock(status_code=200, content=b'{".kibana_2": {"mappings": {}}}')
+
+        with tempfile.TemporaryDirectory() as test_dir:
+            file_name = os.path.join(test_dir, 'kcing.kibana')
+            mapping = os.path.join(test_dir, 'kibana.json')
+            with patch.object(kibana, 'page_size', 7), patch.object(kibana, 'kibana_filename', file_name), \
+                 patch.object(kibana, 'kibana_mapping', mapping), patch.object(kibana.transport, 'client') as client:
+                client().post.side_effect = search
+                client().get.side_effect = get
+                self.assertEqual(kibana.backup(None), 0)
+
+            # Paging through objects must produce the very same file as dumping them all at once
+            for hit in hits:
+                del hit['sort']
+            with open(file_name) as fh:
+                self.assertEqual(fh.read(), json.dumps(hits, sort_keys=True, indent=2))
+
+            with open(mapping) as fh:
+                self.assertEqual(json.load(fh)['index_patterns'], ['.kibana_2'])
+
+        self.assertEqual(json.loads(client().post.call_args[1]['data'])['sort'], [{'type': 'asc'}, {'_seq_no': 'asc'}])
+
+    def test_backup_cleans_up(self):
+        def search(url, headers=None, data=None):
+            return MagicMock(status_code=200, content=b'not json')
+
+        with tempfile.TemporaryDirectory() as test_dir:
+            file_name = os.path.join(test_dir, 'kcing.kibana')
+            with patch.object(kibana.transport, 'client') as client:
+                client().post.side_effect = search
+                with self.assertRaises(ValueError):
+                    kibana._backup_objects('.kibana_1', file_name)
+
+            self.assertEqual(os.listdir(test_dir), [])
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#/usr/bin/env python3
+
+import unittest
+import logging
+import json
+from datetime import datetime
+
+from unittest.mock import patch
+
+import lava
+import settings
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+results = """
+- {name: auto-login-action, result: pass, measurement: 4.2, unit: seconds, suite: lava, level: '1.1',
+   logged: '2019-02-13 10:15:40.437371+00:00', log_start_line: 10, log_end_line: 12, id: 42,
+   metadata: {duration: 4.2}, job: '1234', url: /results/1234}
+- {name: test-one, result: fail}
+"""
+
+log = """
+- {dt: '2019-02-13T10:15:40.437371', lvl: info, msg: 'start: 1.1 auto-login-action'}
+- {dt: '2019-02-13T10:15:41.123456', lvl: target, msg: 'login:'}
+- {dt: '2019-02-13T10:15:42.123456', lvl: target, msg: 'root'}
+"""
+
+definition = """
+metadata:
+  git.commit: abcdef
+  git.branch: master
+  git.describe: v5.0
+  kernel.tree: mainline
+  kernel.version: v5.0
+  kernel.defconfig: defconfig
+  job.build_environment: gcc-8
+  device.type: beaglebone-black
+  job.arch: arm
+  job.file_server_resource: mainline/master/v5.0/arm/defconfig/gcc-8
+  platform.mach: omap2
+  kernel.endian: little
+  platform.name: am335x-boneblack
+"""
+
+
+class TestLava(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime(2019, 2, 13, 10, 20, 30, 123456)
+        self.lava = {
+            'id': 1234,
+            'lab_name': 'lab-test',
+            'status': 'Complete',
+            'results': {'0_lava': results},
+            'log': log,
+            'definition': definition,
+        }
+
+    def test_transform_lava(self):
+        docs = lava.transform('lava', json.dumps(self.lava), self.now)
+        indices = [index for index, doc in docs]
+        self.assertEqual(indices, ['boot-2019.02.13'] + ['test-2019.02.13'] * 2 + ['log-2019.02.13'] * 3)
+
+        boot = docs[0][1]
+        self.assertEqual(boot['lab_name'], 'lab-test')
+        self.assertEqual(boot['board'], 'beaglebone-black')
+        self.assertEqual(boot['boot_result'], 'pass')
+        self.assertEqual(boot['boot_time'], 4.2)
+        self.assertEqual(boot['@timestamp'], '2019-02-13T10:20:30.123Z')
+        for field in ['id', 'status', 'results', 'log', 'definition']:
+            self.assertNotIn(field, boot)
+
+        test = docs[1][1]
+        self.assertEqual(test['job_id'], '1234')
+        self.assertEqual(test['measurement'], '4.2')
+        self.assertEqual(test['logged'], '2019-02-13 10:15:40.437')
+        self.assertEqual(test['id'], '42')
+
+        # lab-bjorn like results get their gaps filled in
+        test = docs[2][1]
+        self.assertEqual(test['suite'], 'lava')
+        self.assertEqual(test['measurement'], '0')
+        self.assertEqual(test['logged'], '2019-02-13T10:20:30.123Z')
+
+        log = docs[4][1]
+        self.assertEqual(log['lineno'], '2')
+        self.assertEqual(log['dt'], '2019-02-13T10:15:41.123')
+        self.assertEqual(log['msg'], 'login:')
+
+    def test_transform_lava_log_chunk(self):
+        with patch.object(settings, 'KCING_LOG_CHUNK', 2):
+            docs = lava.transform('lava', json.dumps(self.lava), self.now)
+
+        logs = [doc for index, doc in docs if index.startswith('log-')]
+        self.assertEqual(len(logs), 2)
+
+        self.assertEqual(logs[0]['lineno_start'], 1)
+        self.assertEqual(logs[0]['lineno_end'], 2)
+        self.assertEqual(logs[0]['lineno'], 1)
+        self.assertEqual(logs[0]['dt'], '2019-02-13T10:15:40.437')
+        self.assertEqual(logs[0]['lvl'], ['info', 'target'])
+        self.assertEqual(logs[0]['msg'], 'start: 1.1 auto-login-action\nlogin:')
+        self.assertEqual(logs[0]['board'], 'beaglebone-black')
+        self.assertEqual(logs[0]['job_id'], '1234')
+
+        self.assertEqual(logs[1]['lineno_start'], 3)
+        self.assertEqual(logs[1]['lineno_end'], 3)
+        self.assertEqual(logs[1]['lvl'], ['target'])
+        self.assertEqual(logs[1]['msg'], 'root')
+
+    def test_doc_ids(self):
+        docs = lava.transform('lava', json.dumps(self.lava), self.now)
+        self.assertEqual(lava.doc_ids('abc', docs), ['abc', 'abc-t-0', 'abc-t-1', 'abc-l-1', 'abc-l-2', 'abc-l-3'])
+
+        with patch.object(settings, 'KCING_LOG_CHUNK', 2):
+            docs = lava.transform('lava', json.dumps(self.lava), self.now)
+        self.assertEqual(lava.doc_ids('abc', docs)[-2:], ['abc-l-1', 'abc-l-3'])
+
+    def test_transform_invalid(self):
+        del self.lava['definition']
+        with self.assertRaises(lava.InvalidDocument):
+            lava.transform('lava', json.dumps(self.lava), self.now)
+
+        with self.assertRaises(lava.InvalidDocument):
+            lava.transform('build', 'not json', self.now)
+
+    def test_transform_boot(self):
+        boot = {'boot_result': 'PASS', 'kernel': 'v5.0', 'fastboot': False}
+        docs = lava.transform('boot', json.dumps(boot), self.now)
+
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0][0], 'boot-2019.02.13')
+        self.assertEqual(docs[0][1]['boot_result'], 'pass')
+        self.assertEqual(docs[0][1]['git_describe'], 'v5.0')
+        self.assertNotIn('fastboot', docs[0][1])
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
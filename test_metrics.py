@@ -0,0 +1,73 @@
+#/usr/bin/env python3
+
+import unittest
+import logging
+import json
+import os
+import tempfile
+
+import metrics
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_counters(self):
+        metrics.inc('kcing_posts_total', type='lava', result='ok')
+        metrics.inc('kcing_posts_total', 2, result='ok', type='lava')
+        metrics.inc('kcing_posts_total', type='build', result='failed')
+
+        summary = metrics.summary()
+        self.assertEqual(summary['kcing_posts_total{result="ok",type="lava"}'], 3)
+        self.assertEqual(summary['kcing_posts_total{result="failed",type="build"}'], 1)
+
+    def test_histograms(self):
+        metrics.observe('kcing_post_seconds', 0.02)
+        metrics.observe('kcing_post_seconds', 0.2)
+        with metrics.timer('kcing_post_seconds'):
+            pass
+
+        summary = metrics.summary()['kcing_post_seconds']
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['max'], 0.2)
+
+        text = metrics.prometheus()
+        self.assertIn('# TYPE kcing_post_seconds histogram', text)
+        self.assertIn('kcing_post_seconds_bucket{le="0.025"} 2', text)
+        self.assertIn('kcing_post_seconds_bucket{le="0.25"} 3', text)
+        self.assertIn('kcing_post_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('kcing_post_seconds_count 3', text)
+
+    def test_write(self):
+        metrics.inc('kcing_csrf_refreshes_total')
+        metrics.gauge('kcing_last_feed_timestamp_seconds', 42)
+
+        with tempfile.TemporaryDirectory() as test_dir:
+            prometheus_file = os.path.join(test_dir, 'kcing.prom')
+            json_file = os.path.join(test_dir, 'kcing.json')
+            metrics.write(prometheus_file, json_file)
+
+            self.assertEqual(sorted(os.listdir(test_dir)), ['kcing.json', 'kcing.prom'])
+            with open(prometheus_file) as fh:
+                text = fh.read()
+            self.assertIn('# TYPE kcing_csrf_refreshes_total counter\nkcing_csrf_refreshes_total 1\n', text)
+            self.assertIn('# TYPE kcing_last_feed_timestamp_seconds gauge\n', text)
+
+            with open(json_file) as fh:
+                self.assertEqual(json.load(fh)['kcing_last_feed_timestamp_seconds'], 42)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
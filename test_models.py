@@ -4,9 +4,13 @@ import unittest
 import logging
 import os
 import shutil
+from datetime import datetime
+from unittest.mock import patch
 
 import settings
-from models import init, end, create_tables, all_objs, save, delete_old
+from models import init, end, create_tables, all_objs, existing, save, delete_old, get_watermark, set_watermark
+from models import record_failures, due_failures, pending_failures, clear_failures, Failure
+from models import ingested, save_digests, Object, kcingdb, _has_unique_index
 
 
 logger = logging.getLogger()
@@ -40,6 +44,70 @@ class TestModels(unittest.TestCase):
         self.assertEqual(len(lavas), 0)
         self.assertEqual(len(builds), 0)
 
+    def test_save_is_idempotent(self):
+        self.assertEqual(save('build', {'1': 'build1', '3': 'build3'}), 1)
+        self.assertEqual(len(all_objs('build')), 3)
+
+    def test_existing(self):
+        self.assertEqual(existing(['build'], ['1', '2', '4']), {'1', '2'})
+        self.assertEqual(existing(['build', 'lava'], ['3', '4']), {'3'})
+        self.assertEqual(existing(['boot'], ['1']), set())
+
+    def test_failures(self):
+        self.assertEqual(record_failures('build', 'download', {'1': 'url1', '2': 'url2'}), [])
+        self.assertEqual(due_failures('build', 'download'), {})
+        self.assertEqual(pending_failures(['build'], 'download', ['1', '3']), {'1'})
+
+        # Make it due for next attempt
+        Failure.update(next_attempt=datetime.now()).where(Failure.oid == '1').execute()
+        self.assertEqual(due_failures('build', 'download'), {'1': 'url1'})
+        self.assertEqual(pending_failures(['build'], 'download', ['1', '3']), set())
+
+        # Give up after max attempts
+        for attempt in range(settings.KCING_MAX_ATTEMPTS - 2):
+            record_failures('build', 'download', {'1': 'url1'})
+        self.assertEqual(record_failures('build', 'download', {'1': 'url1'}), ['1'])
+        Failure.update(next_attempt=datetime.now()).where(Failure.oid == '1').execute()
+        self.assertEqual(due_failures('build', 'download'), {})
+        self.assertEqual(pending_failures(['build'], 'download', ['1']), {'1'})
+
+        self.assertEqual(clear_failures('build', 'download', ['1', '2']), 2)
+
+    def test_unique_index(self):
+        self.assertTrue(_has_unique_index(Object, ['type', 'oid']))
+
+        # Duplicates are only looked for in databases created before the index
+        with patch('models._delete_duplicates') as delete_duplicates:
+            init()
+        delete_duplicates.assert_not_called()
+
+        # An older database without the index gets its duplicates deleted and the index created
+        kcingdb.execute_sql('DROP INDEX object_type_oid')
+        Object.insert(_type='build', oid='1').execute()
+        self.assertEqual(len(Object.select().where(Object._type == 'build', Object.oid == '1')), 2)
+
+        init()
+        self.assertEqual(len(Object.select().where(Object._type == 'build', Object.oid == '1')), 1)
+        self.assertTrue(_has_unique_index(Object, ['type', 'oid']))
+
+    def test_digests(self):
+        self.assertEqual(save_digests('build', {'1': 'aaa', '2': 'bbb'}), 2)
+
+        # Content keeps the first oid it was sent with
+        self.assertEqual(save_digests('build', {'3': 'aaa'}), 0)
+        self.assertEqual(ingested('build', ['aaa', 'ccc']), {'aaa': '1'})
+        self.assertEqual(ingested('lava', ['aaa']), {})
+
+        delete_old(0)
+        self.assertEqual(ingested('build', ['aaa', 'bbb']), {})
+
+    def test_watermark(self):
+        self.assertIsNone(get_watermark('watermark'))
+
+        set_watermark('watermark', datetime(2019, 1, 1), '1')
+        set_watermark('watermark', datetime(2019, 1, 2), '2')
+        self.assertEqual(get_watermark('watermark'), (datetime(2019, 1, 2), '2'))
+
 def main():
     if 'test' not in settings.KCING_DB:
         logger.error('Database for testing should contain the word "test" in it')
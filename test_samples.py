@@ -4,6 +4,7 @@ import unittest
 import logging
 import os
 import shutil
+from unittest.mock import MagicMock, patch
 
 import samples
 
@@ -42,6 +43,27 @@ class TestSamples(unittest.TestCase):
         self.assertEqual(len(files), 1)
         self.assertEqual(files, ['build_1.json'])
 
+    def test_download_sample_is_atomic(self):
+        def broken_stream(chunk_size):
+            yield b'{"partial": '
+            raise IOError('connection reset')
+
+        response = MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_content.side_effect = broken_stream
+        with patch.object(samples, '_client') as client:
+            client.return_value.get.return_value = response
+            file_name, link = samples._download_sample('build', '1', 'https://linaro.org', self.test_dir)
+            self.assertIsNone(file_name)
+            self.assertEqual(os.listdir(self.test_dir), [])
+
+            response.iter_content.side_effect = lambda chunk_size: iter([b'{"a": ', b'1}'])
+            file_name, link = samples._download_sample('build', '1', 'https://linaro.org', self.test_dir)
+            self.assertEqual(file_name, 'build_1.json')
+            self.assertEqual(os.listdir(self.test_dir), ['build_1.json'])
+            with open(os.path.join(self.test_dir, file_name)) as f:
+                self.assertEqual(f.read(), '{"a": 1}')
+
     def test_gen(self):
         self.args.sample_size = 1
         self.args.samples_dir = self.test_dir
@@ -0,0 +1,67 @@
+#/usr/bin/env python3
+
+import unittest
+import logging
+import json
+
+import lava
+import templates
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class TestTemplates(unittest.TestCase):
+
+    def test_generate(self):
+        template = templates.generate('test', keyword_fields={'arch', 'measurement'})
+        properties = template['mappings']['properties']
+
+        self.assertEqual(template['index_patterns'], ['test-*'])
+        self.assertNotIn('codec', template['settings'])
+
+        # Identifiers are keyword only, unless kibana refers to their keyword subfield
+        self.assertEqual(properties['job_id'], {'type': 'keyword', 'ignore_above': 256})
+        self.assertEqual(properties['arch']['type'], 'keyword')
+        self.assertEqual(properties['arch']['fields']['keyword']['type'], 'keyword')
+        self.assertFalse(properties['arch']['doc_values'])
+
+        self.assertEqual(properties['measurement']['type'], 'float')
+        self.assertIn('keyword', properties['measurement']['fields'])
+        self.assertEqual(properties['log_start_line'], {'type': 'long', 'ignore_malformed': True})
+        self.assertEqual(properties['logged']['type'], 'date')
+
+        # No field is analyzed text with norms
+        for name, field in properties.items():
+            self.assertNotEqual(field.get('norms'), True)
+
+    def test_generate_best_compression(self):
+        template = templates.generate('log', best_compression=True, keyword_fields=set())
+        self.assertEqual(template['settings']['codec'], 'best_compression')
+        self.assertEqual(template['mappings']['properties']['msg'], {'type': 'text', 'norms': False})
+        self.assertEqual(template['mappings']['properties']['lineno']['type'], 'long')
+
+    def test_kibana_keyword_fields(self):
+        fields = templates.kibana_keyword_fields()
+        self.assertIn('arch', fields)
+        self.assertIn('git_describe', fields)
+
+    def test_schema_covers_documents(self):
+        # Every field lava.py produces should be declared, so none of them falls back to dynamic mapping
+        for index_type in ['test', 'log']:
+            for field in list(lava.definition_fields.keys()) + ['boot_result', 'boot_time', 'job_id', '@timestamp']:
+                self.assertIn(field, templates.schema[index_type])
+
+        for field in lava.test_fields:
+            self.assertIn(field, templates.schema['test'])
+
+        for field in lava.log_fields + lava.log_chunk_fields:
+            self.assertIn(field, templates.schema['log'])
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
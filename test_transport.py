@@ -0,0 +1,127 @@
+#/usr/bin/env python3
+
+import unittest
+import logging
+import io
+
+import requests
+from unittest.mock import MagicMock, patch
+
+from urllib3.exceptions import NewConnectionError
+
+import settings
+import transport
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def response(status_code, headers=None):
+    return MagicMock(status_code=status_code, headers=headers or {})
+
+
+class TestTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.session = transport.Session()
+
+    def request(self, responses, **kwargs):
+        """Make a request getting `responses` one after the other, returns (response, super request mock, sleep mock)"""
+        with patch.object(requests.Session, 'request', side_effect=responses) as request, patch.object(transport.time, 'sleep') as sleep:
+            return self.session.post('http://localhost/lala', **kwargs), request, sleep
+
+    def test_no_retry(self):
+        ok, request, sleep = self.request([response(200)])
+        self.assertEqual(ok.status_code, 200)
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(request.call_args[1]['timeout'], (settings.KCING_HTTP_CONNECT_TIMEOUT, settings.KCING_HTTP_TIMEOUT))
+        sleep.assert_not_called()
+
+        # Client errors are not transient
+        not_found, request, sleep = self.request([response(404)])
+        self.assertEqual(not_found.status_code, 404)
+        self.assertEqual(request.call_count, 1)
+
+    def test_retry_after(self):
+        ok, request, sleep = self.request([response(429, {'Retry-After': '7'}), response(200)])
+        self.assertEqual(ok.status_code, 200)
+        self.assertEqual(request.call_count, 2)
+        sleep.assert_called_once_with(7)
+
+    def test_gives_up(self):
+        busy, request, sleep = self.request([response(503)] * 3, retries=2, idempotent=True)
+        self.assertEqual(busy.status_code, 503)
+        self.assertEqual(request.call_count, 3)
+
+        with self.assertRaises(requests.ConnectionError):
+            self.request(requests.ConnectionError('refused'), retries=2, idempotent=True)
+
+    def test_not_idempotent(self):
+        # Posts that might have been processed are not sent again
+        busy, request, sleep = self.request([response(503), response(200)])
+        self.assertEqual(busy.status_code, 503)
+        self.assertEqual(request.call_count, 1)
+
+        with self.assertRaises(requests.ConnectionError):
+            self.request([requests.ConnectionError('reset'), response(200)])
+
+        # Unless they were turned down, or never left
+        ok, request, sleep = self.request([response(429), response(200)])
+        self.assertEqual(ok.status_code, 200)
+
+        refused = requests.ConnectionError(MagicMock(reason=NewConnectionError(None, 'refused')))
+        ok, request, sleep = self.request([refused, requests.ConnectTimeout('timed out'), response(200)])
+        self.assertEqual(ok.status_code, 200)
+        self.assertEqual(request.call_count, 3)
+
+        # Gets are fine either way
+        with patch.object(requests.Session, 'request', side_effect=[response(503), response(200)]), patch.object(transport.time, 'sleep'):
+            self.assertEqual(self.session.get('http://localhost/lala').status_code, 200)
+
+    def test_rewinds_files(self):
+        data = io.BytesIO(b'{"a": 1}')
+        reads = []
+        def read_body(method, url, data=None, **kwargs):
+            reads.append(data.read())
+            return response(502 if len(reads) == 1 else 200)
+
+        ok, request, sleep = self.request(read_body, data=data, idempotent=True)
+        self.assertEqual(ok.status_code, 200)
+        self.assertEqual(reads, [b'{"a": 1}', b'{"a": 1}'])
+
+    def test_backoff(self):
+        for attempt in range(1, 5):
+            delay = settings.KCING_HTTP_BACKOFF * 2 ** (attempt - 1)
+            wait_for = transport.backoff(attempt)
+            self.assertTrue(delay / 2 <= wait_for <= delay)
+
+        self.assertTrue(transport.backoff(30) <= settings.KCING_HTTP_BACKOFF_MAX)
+        self.assertEqual(transport.backoff(1, response(503, {'Retry-After': '100000'})), settings.KCING_HTTP_BACKOFF_MAX)
+
+    def test_pool_sizes(self):
+        with patch.object(settings, 'KCING_HTTP_POOL_SIZES', 'http://localhost:9200=4, http://localhost:8338=2'):
+            sizes = transport._pool_sizes()
+
+        self.assertEqual(sizes['http://localhost:9200'], 4)
+        self.assertEqual(sizes['http://localhost:8338'], 2)
+        self.assertEqual(sizes[settings.KCI_STORAGE_URL], settings.KCI_DOWNLOAD_WORKERS)
+
+    def test_mount(self):
+        client = MagicMock()
+        with patch.object(transport, 'client', return_value=client), \
+             patch.object(settings, 'KCING_HTTP_POOL_SIZES', 'http://localhost:9200=4'):
+            transport.mount('http://localhost:8338', 2)
+            self.assertEqual(client.mount.call_args[0][1]._pool_maxsize, 2)
+
+            # Sizes set explicitly are left alone
+            client.reset_mock()
+            transport.mount('http://localhost:9200', 2)
+            client.mount.assert_not_called()
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# Http transport shared by everything talking to KernelCI, storage, logstash,
+# ElasticSearch and kibana: a single keep-alive session with connection pools
+# sized per host, default timeouts and retries with jittered exponential backoff
+
+import logging
+import random
+import threading
+import time
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+import settings
+
+logger = logging.getLogger()
+
+# Responses worth trying again, anything else is up to the caller
+retry_statuses = [429, 502, 503, 504]
+
+# Requests that can be sent twice without harm. Others are only retried when the
+# server surely didn't process them, see Session.request
+idempotent_methods = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+session = None
+session_lock = threading.Lock()
+
+
+def backoff(attempt, response=None):
+    """
+    Seconds to wait before retry number `attempt` (1, 2, ...). Retry-After sent by
+    the server takes precedence, otherwise it's exponential with jitter, so that
+    concurrent workers don't all come back at the same time
+    """
+    retry_after = _retry_after(response)
+    if retry_after is not None:
+        return min(retry_after, settings.KCING_HTTP_BACKOFF_MAX)
+
+    delay = min(settings.KCING_HTTP_BACKOFF_MAX, settings.KCING_HTTP_BACKOFF * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _never_sent(e):
+    """Whether a connection error happened before the request made it to the server"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if len(e.args) else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _retry_after(response):
+    """Retry-After can be either a number of seconds or an http date"""
+    if response is None:
+        return None
+
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        logger.warning('Ignoring unexpected Retry-After "%s"' % (value))
+        return None
+
+
+class Session(requests.Session):
+    """
+    requests.Session with default timeouts and retries of transient failures. Posts may
+    have been processed even if they failed, so unless the caller says they're `idempotent`
+    (e.g. documents with deterministic ids) they're only retried when the server turned
+    them down (429) or they couldn't be sent at all
+    """
+
+    def request(self, method, url, retries=None, idempotent=None, **kwargs):
+        retries = settings.KCING_HTTP_RETRIES if retries is None else retries
+        if idempotent is None:
+            idempotent = method.upper() in idempotent_methods
+        kwargs.setdefault('timeout', (settings.KCING_HTTP_CONNECT_TIMEOUT, settings.KCING_HTTP_TIMEOUT))
+
+        data = kwargs.get('data')
+        position = data.tell() if hasattr(data, 'tell') else 0
+
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = super(Session, self).request(method, url, **kwargs)
+                if response.status_code not in retry_statuses:
+                    return response
+                if response.status_code != 429 and not idempotent:
+                    return response
+                reason = 'http %i' % (response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries or not (idempotent or _never_sent(e)):
+                    raise
+                reason = e.__class__.__name__
+
+            if attempt >= retries:
+                return response
+
+            attempt += 1
+            wait_for = backoff(attempt, response)
+            logger.warning('%s "%s" failed (%s), retry %i of %i in %.2f seconds' % (method.upper(), url, reason, attempt, retries, wait_for))
+            metrics.inc('kcing_http_retries_total', host=urlparse(url).netloc)
+
+            if response is not None:
+                response.close()
+            time.sleep(wait_for)
+
+            # Bodies streamed from files have to be read again from their start
+            if hasattr(data, 'seek'):
+                data.seek(position)
+
+
+def _pool_sizes():
+    """Connection pool size of each base url, hosts worked on concurrently need bigger pools"""
+    sizes = {
+        '%s://%s' % (settings.KCI_SCHEME, settings.KCI_HOST): settings.KCI_LISTING_WORKERS,
+        settings.KCI_STORAGE_URL: settings.KCI_DOWNLOAD_WORKERS,
+    }
+
+    sizes.update(_configured_pool_sizes())
+    return sizes
+
+
+def _configured_pool_sizes():
+    """Pool sizes set in KCING_HTTP_POOL_SIZES"""
+    sizes = {}
+
+    # e.g. KCING_HTTP_POOL_SIZES="https://storage.kernelci.org=16,http://localhost:9200=4"
+    for item in (settings.KCING_HTTP_POOL_SIZES or '').split(','):
+        if '=' in item:
+            url, size = item.rsplit('=', 1)
+            sizes[url.strip()] = int(size)
+
+    return sizes
+
+
+def mount(url, pool_size):
+    """
+    Give requests to urls starting with `url` their own pool of `pool_size` connections,
+    unless KCING_HTTP_POOL_SIZES sets one for it already
+    """
+    if url in _configured_pool_sizes():
+        return
+
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    client().mount(url, adapter)
+
+
+def client():
+    global session
+
+    # Threads may ask for it at the same time, only one of them gets to create it
+    with session_lock:
+        if session is None:
+            new_session = Session()
+            new_session.headers['Connection'] = 'keep-alive'
+
+            adapter = HTTPAdapter(pool_maxsize=settings.KCING_HTTP_POOL_SIZE)
+            new_session.mount('http://', adapter)
+            new_session.mount('https://', adapter)
+
+            for url, size in _pool_sizes().items():
+                new_session.mount(url, HTTPAdapter(pool_maxsize=size))
+
+            session = new_session
+
+    return session